@@ -10,6 +10,7 @@ import sys
 import unittest
 
 import regex.tests
+from regex.search import search
 
 from docopt import docopt
 
@@ -18,10 +19,17 @@ def main(argv=sys.argv):
     """
     Usage:
       regex test [<args>...]
+      regex search [--jobs=<jobs>] [--unordered] [--ignore-case] <regex>
+                   <path>...
       regex -h | --help
 
     Options:
-      -h --help  Show this.
+      -h --help         Show this.
+      --jobs=<jobs>     Number of processes searching files, defaults to the
+                        number of CPUs.
+      --unordered       Print matching lines as soon as they are found
+                        instead of in the order of the files.
+      -i --ignore-case  Match the regex ignoring case.
     """
     arguments = docopt(main.__doc__, argv[1:], help=True)
     if arguments["test"]:
@@ -30,6 +38,34 @@ def main(argv=sys.argv):
             argv=argv[0:1] + arguments["<args>"],
             buffer=True
         )
+    elif arguments["search"]:
+        jobs = arguments["--jobs"]
+        failed = []
+
+        def report(path, error):
+            # like grep, unreadable files are reported but do not end the
+            # search
+            failed.append(path)
+            sys.stderr.write("regex: %s: %s\n" % (
+                path, error.strerror or error
+            ))
+
+        results = search(
+            arguments["<regex>"].decode(sys.getfilesystemencoding()),
+            arguments["<path>"],
+            jobs=None if jobs is None else int(jobs),
+            ordered=not arguments["--unordered"],
+            ignore_case=arguments["--ignore-case"],
+            on_error=report
+        )
+        for path, line_number, line in results:
+            sys.stdout.write(
+                (u"%s:%d:%s\n" % (
+                    path.decode(sys.getfilesystemencoding()), line_number, line
+                )).encode("utf-8")
+            )
+        if failed:
+            sys.exit(2)
 
 if __name__ == "__main__":
     main()
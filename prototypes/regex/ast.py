@@ -6,68 +6,376 @@
     :copyright: 2012 by Daniel Neuhäuser
     :license: BSD, see LICENSE.rst
 """
-from regex.fa import NFA, NFAState
+import sys
+from itertools import izip, imap
+from threading import RLock
+from weakref import WeakValueDictionary
+
+from regex.fa import (
+    NFA, NFAState, CounterStartState, CounterLoopState, TagState, TaggedNFA,
+    PositionAutomaton, BitParallelNFA, DerivativeDFA, iter_bits
+)
+from regex.intervals import IntervalSet
+
+
+#: Counted repetitions with more repetitions than this are compiled to NFAs
+#: using counters, instead of a copy of the repeated NFA per repetition.
+MAX_EXPANDED_REPETITIONS = 16
+
+
+def is_complete(alphabet):
+    """
+    Returns `True` if `alphabet` contains every character, in which case
+    automata use default transitions instead of enumerating the alphabet.
+    """
+    return len(alphabet) >= sys.maxunicode
+
+
+def get_sort_key(value):
+    """
+    Returns a key for the given regex or regex argument, that orders values
+    by their structure and is therefore the same in every process.
+    """
+    if isinstance(value, Regex):
+        return value.sort_key
+    elif isinstance(value, (set, frozenset)):
+        return tuple(sorted(imap(get_sort_key, value)))
+    elif isinstance(value, IntervalSet):
+        return value.intervals
+    elif isinstance(value, UnicodeAlphabet):
+        return (value.__class__.__name__, )
+    return value
+
+
+class UnicodeAlphabet(object):
+    """
+    The alphabet of all characters. It can be used like a frozenset of
+    :class:`Character`\s, without constructing a character for every code
+    point until it is iterated.
+    """
+    def __len__(self):
+        return sys.maxunicode
+
+    def __contains__(self, character):
+        return (
+            isinstance(character, Character) and
+            ord(character.raw) < sys.maxunicode
+        )
+
+    def __iter__(self):
+        for i in xrange(sys.maxunicode):
+            yield Character(unichr(i))
+
+    def __and__(self, other):
+        return frozenset(
+            character for character in other if character in self
+        )
+
+    __rand__ = __and__
+
+    def __sub__(self, other):
+        return frozenset(
+            character for character in self if character not in other
+        )
+
+    def __repr__(self):
+        return "%s()" % self.__class__.__name__
+
+
+class RegexMeta(type):
+    """
+    Interns regexes, constructing a regex with the same class and arguments
+    as an existing one returns the existing regex instead of a new one.
+
+    As the arguments of a regex are interned themselves, equal regexes are
+    identical and can be compared in constant time. The hash of a regex and
+    its `sort_key`, which orders regexes structurally, are computed once,
+    when it is constructed.
+
+    Instances are kept in the `instances` mapping of their class. Existing
+    regexes are looked up without locking, new regexes are constructed under
+    a lock, so that threads - compiling regexes in the background - never
+    construct equal but different regexes.
+    """
+    lock = RLock()
+
+    def __call__(cls, *args):
+        key = (cls, ) + args
+        regex = cls.instances.get(key)
+        if regex is not None:
+            return regex
+        with RegexMeta.lock:
+            regex = cls.instances.get(key)
+            if regex is None:
+                regex = cls.__new__(cls, *args)
+                if "_hash" not in regex.__dict__:
+                    regex.__init__(*args)
+                    regex._hash = hash(key)
+                    regex.sort_key = (cls.__name__, ) + tuple(
+                        imap(get_sort_key, args)
+                    )
+                    cls.instances[key] = regex
+        return regex
 
 
 class Regex(object):
-    def to_nfa(self):
+    __metaclass__ = RegexMeta
+
+    instances = WeakValueDictionary()
+
+    def to_nfa(self, groups=None):
+        """
+        Returns an :class:`NFA` for this regex. If `groups` is a
+        :class:`GroupNumbers` object, the groups are numbered with it and
+        their boundaries are marked with :class:`TagState`\s.
+        """
+        raise NotImplementedError()
+
+    def to_tagged_nfa(self):
+        """
+        Returns a :class:`TaggedNFA` for this regex, that reports the spans of
+        the groups of a match. Groups are numbered from 1, in the order of
+        their opening parentheses.
+
+        Optimizing a regex removes the groups, so this has to be called on an
+        unoptimized regex.
+        """
+        groups = GroupNumbers()
+        nfa = self.to_nfa(groups)
+        return TaggedNFA(nfa.start, nfa.final, groups.count)
+
+    def to_position_automaton(self, cls=PositionAutomaton):
+        """
+        Returns a :class:`PositionAutomaton` for this regex, using the
+        construction by Glushkov.
+        """
+        characters = [frozenset()]
+        follow = [0]
+        nullable, first, last = self._linearize(characters, follow)
+        follow[0] = first
+        return cls(characters, follow, last | nullable)
+
+    def to_bit_parallel_nfa(self):
+        """
+        Returns a :class:`BitParallelNFA` for this regex.
+        """
+        return self.to_position_automaton(BitParallelNFA)
+
+    def _linearize(self, characters, follow):
+        """
+        Assigns a position to every character set in this regex, by appending
+        the characters and an empty follow set to the given lists, and
+        returns a tuple ``(nullable, first, last)``, where `nullable` is 1 if
+        the regex matches the empty string and 0 otherwise and `first` and
+        `last` are bitsets of the positions that can start or end a match.
+
+        The follow sets of the positions are updated in place.
+
+        By default the regex is treated as a single position matching the
+        characters returned by :meth:`_raw_characters`.
+        """
+        position = len(characters)
+        characters.append(frozenset(self._raw_characters()))
+        follow.append(0)
+        return 0, 1 << position, 1 << position
+
+    def _raw_characters(self):
+        raise NotImplementedError()
+
+    def to_derivative_dfa(self):
+        """
+        Returns a :class:`DerivativeDFA` for this regex, whose states are
+        computed on demand using Brzozowski derivatives.
+        """
+        return DerivativeDFA(normalize(self), Empty())
+
+    def is_nullable(self):
+        """
+        Returns `True` if this regex matches the empty string.
+        """
+        return False
+
+    def derive(self, character):
+        """
+        Returns the derivative of this regex with respect to the given
+        character, a regex matching the remainder of every string matched by
+        this regex, that starts with the `character`.
+
+        Derivatives are cached, so that derivatives of subexpressions shared
+        between regexes are only computed once.
+        """
+        try:
+            derivatives = self._derivatives
+        except AttributeError:
+            derivatives = self._derivatives = {}
+        try:
+            return derivatives[character]
+        except KeyError:
+            derivative = derivatives[character] = self._derive(character)
+            return derivative
+
+    def _derive(self, character):
+        """
+        Returns the derivative of this regex, without caching it.
+
+        By default the regex is treated as matching a single character, if
+        :meth:`_matches_character` returns `True`.
+        """
+        if self._matches_character(character):
+            return Epsilon()
+        return Empty()
+
+    def _matches_character(self, character):
         raise NotImplementedError()
 
+    def first_characters(self):
+        """
+        Returns a list of character sets. The derivatives of this regex are
+        equal for all characters contained in the same sets and empty for all
+        characters not contained in any set.
+        """
+        return [frozenset(self._raw_characters())]
+
+    def optimize(self):
+        """
+        Returns an equivalent regex, that results in smaller automata.
+        Concatenations and unions are flattened, groups and nested
+        repetitions are removed, common prefixes are factored out of unions
+        and unions of single characters are merged into sets.
+        """
+        return self
+
+    def reverse(self):
+        """
+        Returns a regex matching the reversed strings matched by this regex.
+        """
+        return self
+
+    def expand(self):
+        """
+        Returns an equivalent regex, whose NFA uses no counters, by replacing
+        counted repetitions with :class:`ExpandedRepetition`\s.
+        """
+        return self
+
     def to_dfa(self):
         return self.to_nfa().to_dfa()
 
     def to_dfa_table(self):
         return self.to_dfa().to_dfa_table()
 
-    def compile(self):
-        for method in [self.to_dfa_table, self.to_dfa, self.to_nfa]:
-            try:
-                return method()
-            except NotImplementedError():
-                pass
-        raise
+    def to_searchable_dfa(self):
+        """
+        Returns a :class:`DFATable` for this regex or, if its NFA uses
+        counters and there is no DFA table, a :class:`DerivativeDFA` whose
+        states are computed as they are reached. Both provide `transition`
+        and `finals` for searches driving the DFA themselves.
+        """
+        nfa = self.to_nfa()
+        if nfa.has_counters():
+            return self.to_derivative_dfa()
+        return nfa.to_dfa().to_dfa_table()
+
+    def compile(self, bit_parallel=False):
+        """
+        Returns a matcher for this regex, by default a :class:`DFATable`.
+
+        If `bit_parallel` is true a :class:`BitParallelNFA` is returned
+        instead, which matches more slowly but is constructed much faster,
+        so it is preferable if the regex is used only a few times.
+        """
+        regex = self.optimize()
+        if bit_parallel:
+            return regex.to_bit_parallel_nfa()
+        nfa = regex.to_nfa()
+        if nfa.has_counters():
+            # NFAs with counters cannot be determinized
+            return nfa
+        return nfa.to_dfa().to_dfa_table()
 
     def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return True
-        return NotImplemented
+        return self is other
 
     def __ne__(self, other):
-        return not self == other
+        return self is not other
 
-    __hash__ = NotImplemented
+    def __hash__(self):
+        return self._hash
 
     def __repr__(self):
         return "%s()" % self.__class__.__name__
 
 
 class Epsilon(Regex):
-    def __hash__(self):
-        return 0
-
-    def to_nfa(self):
+    def to_nfa(self, groups=None):
         final = NFAState(final=True)
         start = NFAState(epsilon_moves=[final])
         return NFA(start, final)
 
+    def _linearize(self, characters, follow):
+        return 1, 0, 0
+
+    def is_nullable(self):
+        return True
+
+    def _derive(self, character):
+        return Empty()
+
+    def first_characters(self):
+        return []
+
+
+class Empty(Regex):
+    """
+    Matches nothing, not even the empty string. The parser never produces
+    this, it is the derivative of a regex that cannot match a character.
+    """
+    def to_nfa(self, groups=None):
+        return NFA(NFAState(), NFAState(final=True))
+
+    def _linearize(self, characters, follow):
+        return 0, 0, 0
+
+    def _derive(self, character):
+        return self
+
+    def first_characters(self):
+        return []
+
 
 class Any(Regex):
     def __init__(self, alphabet):
         self.alphabet = alphabet
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.alphabet == other.alphabet
-        return NotImplemented
-
-    def __hash__(self):
-        return hash(self.alphabet)
-
-    def to_nfa(self):
+    def to_nfa(self, groups=None):
         final = NFAState(final=True)
-        start = NFAState({character.raw: final for character in self.alphabet})
+        if is_complete(self.alphabet):
+            start = NFAState(default=final)
+        else:
+            start = NFAState({
+                character.raw: final for character in self.alphabet
+            })
         return NFA(start, final)
 
+    def _linearize(self, characters, follow):
+        if not is_complete(self.alphabet):
+            return Regex._linearize(self, characters, follow)
+        position = len(characters)
+        characters.append(IntervalSet([(0, sys.maxunicode)]))
+        follow.append(0)
+        return 0, 1 << position, 1 << position
+
+    def _raw_characters(self):
+        return (character.raw for character in self.alphabet)
+
+    def first_characters(self):
+        if is_complete(self.alphabet):
+            return [IntervalSet([(0, sys.maxunicode)])]
+        return Regex.first_characters(self)
+
+    def _matches_character(self, character):
+        return Character(character) in self.alphabet
+
     def __repr__(self):
         return "%s(%r)" % (
             self.__class__.__name__,
@@ -84,19 +392,17 @@ class Character(Regex):
     def __init__(self, raw):
         self.raw = raw
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.raw == other.raw
-        return NotImplemented
-
-    def __hash__(self):
-        return hash(self.raw)
-
-    def to_nfa(self):
+    def to_nfa(self, groups=None):
         final = NFAState(final=True)
         start = NFAState({self.raw: final})
         return NFA(start, final)
 
+    def _raw_characters(self):
+        return [self.raw]
+
+    def _matches_character(self, character):
+        return character == self.raw
+
     def __repr__(self):
         return "%s(%r)" % (
             self.__class__.__name__, self.raw
@@ -104,77 +410,246 @@ class Character(Regex):
 
 
 class Operator(Regex):
-    def __new__(cls, left, right):
-        if isinstance(left, Epsilon):
-            return right
-        elif isinstance(right, Epsilon):
-            return left
-        return Regex.__new__(cls, left, right)
-
-    def __init__(self, left, right):
-        self.left = left
-        self.right = right
-
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (
-                self.left == other.left and
-                self.right == other.right
-            )
-        return NotImplemented
+    def __new__(cls, *operands):
+        if len(operands) == 1:
+            return operands[0]
+        return Regex.__new__(cls, *operands)
+
+    def __init__(self, *operands):
+        self.operands = operands
+
+    def optimize(self):
+        operands = []
+        for operand in self.operands:
+            operand = operand.optimize()
+            if isinstance(operand, self.__class__):
+                operands.extend(operand.operands)
+            else:
+                operands.append(operand)
+        return self._optimize_operands(operands)
+
+    def _optimize_operands(self, operands):
+        """
+        Returns an optimized regex for the given flattened and optimized
+        operands.
+        """
+        raise NotImplementedError()
 
-    def __hash__(self):
-        return hash(self.left) ^ hash(self.right)
+    def expand(self):
+        return self.__class__(*[operand.expand() for operand in self.operands])
 
     def __repr__(self):
-        return "%s(%r, %r)" % (
+        return "%s(%s)" % (
             self.__class__.__name__,
-            self.left,
-            self.right
+            ", ".join(map(repr, self.operands))
         )
 
 
 class Concatenation(Operator):
-    def to_nfa(self):
-        left = self.left.to_nfa()
-        right = self.right.to_nfa()
-        left.final.epsilon_moves.append(right.start)
-        left.final.is_final = False
-        return NFA(left.start, right.final)
+    def __new__(cls, *operands):
+        if any(isinstance(operand, Epsilon) for operand in operands):
+            operands = [
+                operand for operand in operands
+                if not isinstance(operand, Epsilon)
+            ]
+            if not operands:
+                return Epsilon()
+            return cls(*operands)
+        return Operator.__new__(cls, *operands)
+
+    def to_nfa(self, groups=None):
+        nfas = []
+        for i, operand in enumerate(self.operands):
+            if groups is not None:
+                if i and isinstance(operand, ContinuedRepetition):
+                    # x+ is parsed as xx*, the groups in both copies of x
+                    # are the same groups.
+                    groups.next = previous
+                previous = groups.next
+            nfas.append(operand.to_nfa(groups))
+        for left, right in izip(nfas, nfas[1:]):
+            left.final.epsilon_moves.append(right.start)
+            left.final.is_final = False
+        return NFA(nfas[0].start, nfas[-1].final)
+
+    def _linearize(self, characters, follow):
+        nullable, first, last = 1, 0, 0
+        for operand in self.operands:
+            (
+                operand_nullable, operand_first, operand_last
+            ) = operand._linearize(characters, follow)
+            for position in iter_bits(last):
+                follow[position] |= operand_first
+            if nullable:
+                first |= operand_first
+            if operand_nullable:
+                last |= operand_last
+            else:
+                last = operand_last
+            nullable &= operand_nullable
+        return nullable, first, last
+
+    def is_nullable(self):
+        return all(operand.is_nullable() for operand in self.operands)
+
+    def _derive(self, character):
+        head, tail = self.operands[0], Concatenation(*self.operands[1:])
+        result = concatenate(head.derive(character), tail)
+        if head.is_nullable():
+            return union(result, tail.derive(character))
+        return result
+
+    def first_characters(self):
+        result = []
+        for operand in self.operands:
+            result.extend(operand.first_characters())
+            if not operand.is_nullable():
+                break
+        return result
+
+    def reverse(self):
+        return Concatenation(*[
+            operand.reverse() for operand in reversed(self.operands)
+        ])
+
+    def _optimize_operands(self, operands):
+        result = []
+        for operand in operands:
+            # x*x* matches the same strings as x*
+            if not (
+                isinstance(operand, Repetition) and
+                result and result[-1] is operand
+            ):
+                result.append(operand)
+        return Concatenation(*result)
 
 
 class Union(Operator):
-    def to_nfa(self):
-        left = self.left.to_nfa()
-        right = self.right.to_nfa()
-        start = NFAState(epsilon_moves=[left.start, right.start])
+    def to_nfa(self, groups=None):
+        nfas = [operand.to_nfa(groups) for operand in self.operands]
+        start = NFAState(epsilon_moves=[nfa.start for nfa in nfas])
         final = NFAState(final=True)
-        left.final.epsilon_moves.append(final)
-        left.final.is_final = False
-        right.final.epsilon_moves.append(final)
-        right.final.is_final = False
+        for nfa in nfas:
+            nfa.final.epsilon_moves.append(final)
+            nfa.final.is_final = False
         return NFA(start, final)
 
+    def _linearize(self, characters, follow):
+        nullable, first, last = 0, 0, 0
+        for operand in self.operands:
+            (
+                operand_nullable, operand_first, operand_last
+            ) = operand._linearize(characters, follow)
+            nullable |= operand_nullable
+            first |= operand_first
+            last |= operand_last
+        return nullable, first, last
+
+    def is_nullable(self):
+        return any(operand.is_nullable() for operand in self.operands)
+
+    def _derive(self, character):
+        return union(*[operand.derive(character) for operand in self.operands])
+
+    def first_characters(self):
+        result = []
+        for operand in self.operands:
+            result.extend(operand.first_characters())
+        return result
+
+    def reverse(self):
+        return Union(*[operand.reverse() for operand in self.operands])
+
+    def _optimize_operands(self, operands):
+        # factor out common prefixes, ab|ac becomes a(b|c)
+        prefixes = []
+        suffixes = {}
+        for operand in operands:
+            if isinstance(operand, Concatenation):
+                prefix = operand.operands[0]
+                suffix = Concatenation(*operand.operands[1:])
+            else:
+                prefix, suffix = operand, Epsilon()
+            if prefix not in suffixes:
+                prefixes.append(prefix)
+                suffixes[prefix] = []
+            if suffix not in suffixes[prefix]:
+                suffixes[prefix].append(suffix)
+        alternatives = [
+            concatenate(prefix, Union(*suffixes[prefix]).optimize())
+            for prefix in prefixes
+        ]
+        # merge single characters into one set, a|[bc] becomes [abc]
+        result = []
+        characters_and_ranges = set()
+        position = None
+        for alternative in alternatives:
+            if isinstance(alternative, Character):
+                characters_and_ranges.add(alternative)
+            elif isinstance(alternative, Either):
+                characters_and_ranges.update(
+                    alternative.characters_and_ranges
+                )
+            else:
+                result.append(alternative)
+                continue
+            if position is None:
+                position = len(result)
+        if position is not None:
+            result.insert(
+                position,
+                Either(frozenset(characters_and_ranges)).optimize()
+            )
+        return Union(*result)
+
 
 class Repetition(Regex):
     def __init__(self, repeated):
         self.repeated = repeated
 
-    def to_nfa(self):
-        repeated = self.repeated.to_nfa()
+    def to_nfa(self, groups=None):
+        repeated = self.repeated.to_nfa(groups)
         final = NFAState(final=True)
         start = NFAState(epsilon_moves=[repeated.start, final])
         repeated.final.is_final = False
         repeated.final.epsilon_moves.append(start)
         return NFA(start, final)
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.repeated == other.repeated
-        return NotImplemented
+    def _linearize(self, characters, follow):
+        _, first, last = self.repeated._linearize(characters, follow)
+        for position in iter_bits(last):
+            follow[position] |= first
+        return 1, first, last
 
-    def __hash__(self):
-        return hash(self.repeated)
+    def is_nullable(self):
+        return True
+
+    def _derive(self, character):
+        return concatenate(
+            self.repeated.derive(character),
+            repeat(self.repeated)
+        )
+
+    def first_characters(self):
+        return self.repeated.first_characters()
+
+    def reverse(self):
+        return Repetition(self.repeated.reverse())
+
+    def optimize(self):
+        repeated = self.repeated.optimize()
+        if isinstance(repeated, Union) and any(
+            isinstance(operand, Epsilon) for operand in repeated.operands
+        ):
+            # (|x)* matches the same strings as x*
+            repeated = Union(*[
+                operand for operand in repeated.operands
+                if not isinstance(operand, Epsilon)
+            ])
+        return repeat(repeated)
+
+    def expand(self):
+        return self.__class__(self.repeated.expand())
 
     def __repr__(self):
         return "%s(%r)" % (
@@ -183,20 +658,189 @@ class Repetition(Regex):
         )
 
 
+class ContinuedRepetition(Repetition):
+    """
+    The repetition in ``xx*``, that ``x+`` is parsed as. It matches the same
+    strings as a :class:`Repetition` but contains the groups of the preceding
+    `x` instead of groups of its own.
+    """
+
+
+class CountedRepetition(Regex):
+    """
+    Matches `repeated` at least `minimum` and at most `maximum` times,
+    without an upper bound if `maximum` is `None`.
+    """
+    def __init__(self, repeated, minimum, maximum):
+        self.repeated = repeated
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @property
+    def copies(self):
+        """
+        The number of times `repeated` is copied, when the repetition is
+        expanded, not including a trailing :class:`Repetition` if there is no
+        upper bound.
+        """
+        return self.minimum if self.maximum is None else self.maximum
+
+    def to_nfa(self, groups=None):
+        if self.copies > MAX_EXPANDED_REPETITIONS:
+            return self._to_counter_nfa(groups)
+        return self._to_expanded_nfa(groups)
+
+    def _to_expanded_nfa(self, groups):
+        if groups is not None:
+            first_group = groups.next
+        final = NFAState(final=True)
+        start = current = NFAState()
+        for i in xrange(self.copies):
+            if groups is not None:
+                # every copy contains the same groups
+                groups.next = first_group
+            repeated = self.repeated.to_nfa(groups)
+            current.epsilon_moves.append(repeated.start)
+            if i >= self.minimum:
+                current.epsilon_moves.append(final)
+            repeated.final.is_final = False
+            current = repeated.final
+        if self.maximum is None:
+            if groups is not None:
+                groups.next = first_group
+            repeated = Repetition(self.repeated).to_nfa(groups)
+            current.epsilon_moves.append(repeated.start)
+            repeated.final.is_final = False
+            current = repeated.final
+        elif self.maximum == 0 and groups is not None:
+            # the groups are never matched but still need their numbers
+            self.repeated.to_nfa(groups)
+        current.epsilon_moves.append(final)
+        return NFA(start, final)
+
+    def _to_counter_nfa(self, groups):
+        repeated = self.repeated.to_nfa(groups)
+        final = NFAState(final=True)
+        loop = CounterLoopState(
+            repeated.start, final, self.minimum, self.maximum
+        )
+        start = CounterStartState(repeated.start, final, self.minimum)
+        repeated.final.is_final = False
+        repeated.final.epsilon_moves.append(loop)
+        return NFA(start, final)
+
+    def _linearize(self, characters, follow):
+        nullable, first, last = 1, 0, 0
+        for i in xrange(self.copies):
+            (
+                repeated_nullable, repeated_first, repeated_last
+            ) = self.repeated._linearize(characters, follow)
+            for position in iter_bits(last):
+                follow[position] |= repeated_first
+            if nullable:
+                first |= repeated_first
+            if i >= self.minimum or repeated_nullable:
+                last |= repeated_last
+            else:
+                last = repeated_last
+                nullable = 0
+        if self.maximum is None:
+            (
+                repeated_nullable, repeated_first, repeated_last
+            ) = Repetition(self.repeated)._linearize(characters, follow)
+            for position in iter_bits(last):
+                follow[position] |= repeated_first
+            if nullable:
+                first |= repeated_first
+            last |= repeated_last
+        return nullable, first, last
+
+    def is_nullable(self):
+        return self.minimum == 0 or self.repeated.is_nullable()
+
+    def _derive(self, character):
+        if self.maximum == 0:
+            return Empty()
+        return concatenate(
+            self.repeated.derive(character),
+            count(
+                self.repeated,
+                max(self.minimum - 1, 0),
+                None if self.maximum is None else self.maximum - 1
+            )
+        )
+
+    def first_characters(self):
+        if self.maximum == 0:
+            return []
+        return self.repeated.first_characters()
+
+    def optimize(self):
+        return count(self.repeated.optimize(), self.minimum, self.maximum)
+
+    def reverse(self):
+        return CountedRepetition(
+            self.repeated.reverse(), self.minimum, self.maximum
+        )
+
+    def expand(self):
+        return ExpandedRepetition(
+            self.repeated.expand(), self.minimum, self.maximum
+        )
+
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (
+            self.__class__.__name__,
+            self.repeated,
+            self.minimum,
+            self.maximum
+        )
+
+
+class ExpandedRepetition(CountedRepetition):
+    """
+    A :class:`CountedRepetition` that is compiled to an NFA with a copy of
+    the repeated NFA per repetition, regardless of the number of copies.
+    """
+    def to_nfa(self, groups=None):
+        return self._to_expanded_nfa(groups)
+
+
 class Group(Regex):
     def __init__(self, grouped):
         self.grouped = grouped
 
-    def to_nfa(self):
-        return self.grouped.to_nfa()
+    def to_nfa(self, groups=None):
+        if groups is None:
+            return self.grouped.to_nfa()
+        number = groups.number()
+        grouped = self.grouped.to_nfa(groups)
+        final = TagState(2 * number + 1, final=True)
+        start = TagState(2 * number, epsilon_moves=[grouped.start])
+        grouped.final.is_final = False
+        grouped.final.epsilon_moves.append(final)
+        return NFA(start, final)
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.grouped == other.grouped
-        return NotImplemented
+    def _linearize(self, characters, follow):
+        return self.grouped._linearize(characters, follow)
 
-    def __hash__(self):
-        return hash(self.grouped)
+    def is_nullable(self):
+        return self.grouped.is_nullable()
+
+    def _derive(self, character):
+        return self.grouped.derive(character)
+
+    def first_characters(self):
+        return self.grouped.first_characters()
+
+    def optimize(self):
+        return self.grouped.optimize()
+
+    def reverse(self):
+        return Group(self.grouped.reverse())
+
+    def expand(self):
+        return Group(self.grouped.expand())
 
     def __repr__(self):
         return "%s(%r)" % (
@@ -209,7 +853,14 @@ class Either(Regex):
     def __init__(self, characters_and_ranges):
         self.characters_and_ranges = characters_and_ranges
 
-    def to_nfa(self):
+    def to_nfa(self, groups=None):
+        final = NFAState(final=True)
+        start = NFAState({
+            character: final for character in self._raw_characters()
+        })
+        return NFA(start, final)
+
+    def _raw_characters(self):
         characters = set()
         for character_or_range in self.characters_and_ranges:
             if isinstance(character_or_range, Character):
@@ -219,17 +870,20 @@ class Either(Regex):
                     characters.add(character.raw)
             else:
                 raise TypeError(character_or_range)
-        final = NFAState(final=True)
-        start = NFAState({character: final for character in characters})
-        return NFA(start, final)
+        return characters
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.characters_and_ranges == other.characters_and_ranges
-        return NotImplemented
+    def _matches_character(self, character):
+        return any(
+            character_or_range._matches_character(character)
+            for character_or_range in self.characters_and_ranges
+        )
 
-    def __hash__(self):
-        return hash(self.characters)
+    def optimize(self):
+        if len(self.characters_and_ranges) == 1:
+            character_or_range, = self.characters_and_ranges
+            if isinstance(character_or_range, Character):
+                return character_or_range
+        return self
 
     def __repr__(self):
         return "%s(%r)" % (
@@ -243,7 +897,32 @@ class Neither(Regex):
         self.characters_and_ranges = characters_and_ranges
         self.alphabet = alphabet
 
-    def to_nfa(self):
+    def to_nfa(self, groups=None):
+        final = NFAState(final=True)
+        if is_complete(self.alphabet):
+            start = NFAState(
+                dict.fromkeys(
+                    (character.raw for character in self._excluded()), None
+                ),
+                default=final
+            )
+        else:
+            start = NFAState({
+                character: final for character in self._raw_characters()
+            })
+        return NFA(start, final)
+
+    def _linearize(self, characters, follow):
+        if not is_complete(self.alphabet):
+            return Regex._linearize(self, characters, follow)
+        position = len(characters)
+        characters.append(IntervalSet.from_characters(
+            character.raw for character in self._excluded()
+        ).complement())
+        follow.append(0)
+        return 0, 1 << position, 1 << position
+
+    def _excluded(self):
         characters = set()
         for character_or_range in self.characters_and_ranges:
             if isinstance(character_or_range, Character):
@@ -253,23 +932,25 @@ class Neither(Regex):
                     characters.add(character)
             else:
                 raise TypeError(character_or_range)
-        characters = self.alphabet - characters
-        final = NFAState(final=True)
-        start = NFAState({
-            character.raw: final for character in characters
-        })
-        return NFA(start, final)
+        return characters
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (
-                self.characters_and_ranges == other.characters_and_ranges and
-                self.alphabet == other.alphabet
-            )
-        return NotImplemented
+    def _raw_characters(self):
+        return (
+            character.raw for character in self.alphabet - self._excluded()
+        )
 
-    def __hash__(self):
-        return hash(self.characters_and_ranges) ^ hash(self.alphabet)
+    def first_characters(self):
+        if is_complete(self.alphabet):
+            return [IntervalSet.from_characters(
+                character.raw for character in self._excluded()
+            ).complement()]
+        return Regex.first_characters(self)
+
+    def _matches_character(self, character):
+        return Character(character) in self.alphabet and not any(
+            character_or_range._matches_character(character)
+            for character_or_range in self.characters_and_ranges
+        )
 
     def __repr__(self):
         return "%s(%r, %r)" % (
@@ -285,17 +966,11 @@ class Range(Regex):
         self.end = end
         self.alphabet = alphabet
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return (
-                self.start == other.start and
-                self.end == other.end and
-                self.alphabet == other.alphabet
-            )
-        return NotImplemented
-
-    def __hash__(self):
-        return hash(self.start) ^ hash(self.end)
+    def _matches_character(self, character):
+        return (
+            self.start.raw <= character <= self.end.raw and
+            Character(character) in self.alphabet
+        )
 
     def __iter__(self):
         for i in xrange(ord(self.start.raw), ord(self.end.raw) + 1):
@@ -309,3 +984,135 @@ class Range(Regex):
             self.start,
             self.end
         )
+
+
+class CharacterClass(Regex):
+    """
+    Matches any of the `characters`, an :class:`IntervalSet`. Unlike
+    :class:`Either`, the characters are never enumerated, which makes large
+    classes - like all letters - practical.
+    """
+    def __init__(self, characters):
+        self.characters = characters
+
+    def to_nfa(self, groups=None):
+        final = NFAState(final=True)
+        start = NFAState(classes=[(self.characters, final)])
+        return NFA(start, final)
+
+    def _linearize(self, characters, follow):
+        position = len(characters)
+        characters.append(self.characters)
+        follow.append(0)
+        return 0, 1 << position, 1 << position
+
+    def _matches_character(self, character):
+        return character in self.characters
+
+    def first_characters(self):
+        return [self.characters]
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.characters)
+
+
+class GroupNumbers(object):
+    """
+    Numbers the groups of a regex, while a tagged NFA for it is constructed.
+    Groups that occur more than once in the NFA, because the regex they are
+    in is repeated, get their number again by resetting :attr:`next`.
+    """
+    def __init__(self):
+        #: The number the next group gets.
+        self.next = 0
+        #: The number of groups.
+        self.count = 0
+
+    def number(self):
+        number = self.next
+        self.next += 1
+        self.count = max(self.count, self.next)
+        return number
+
+
+def concatenate(*regexes):
+    """
+    Returns a regex equivalent to ``Concatenation(*regexes)``, that does not
+    contain :class:`Epsilon` or :class:`Empty` operands or nested
+    concatenations.
+    """
+    operands = []
+    for regex in regexes:
+        if isinstance(regex, Empty):
+            return Empty()
+        elif isinstance(regex, Concatenation):
+            operands.extend(regex.operands)
+        elif not isinstance(regex, Epsilon):
+            operands.append(regex)
+    if not operands:
+        return Epsilon()
+    return Concatenation(*operands)
+
+
+def union(*regexes):
+    """
+    Returns a regex equivalent to ``Union(*regexes)``, in which every
+    alternative occurs only once, :class:`Empty` alternatives and nested
+    unions are removed and the alternatives are in a canonical order.
+
+    Together with :func:`concatenate` and :func:`repeat` this ensures that a
+    regex only has a finite number of distinct derivatives.
+    """
+    alternatives = set()
+    for regex in regexes:
+        if isinstance(regex, Union):
+            alternatives.update(regex.operands)
+        elif not isinstance(regex, Empty):
+            alternatives.add(regex)
+    if not alternatives:
+        return Empty()
+    return Union(*sorted(alternatives, key=get_sort_key))
+
+
+def repeat(regex):
+    """
+    Returns a regex equivalent to ``Repetition(regex)``, that avoids nested
+    or unnecessary repetitions.
+    """
+    if isinstance(regex, (Epsilon, Empty)):
+        return Epsilon()
+    elif isinstance(regex, Repetition):
+        return regex
+    return Repetition(regex)
+
+
+def count(regex, minimum, maximum):
+    """
+    Returns a regex equivalent to ``CountedRepetition(regex, minimum,
+    maximum)``, that avoids unnecessary counted repetitions.
+    """
+    if maximum == 0 or isinstance(regex, (Epsilon, Empty)):
+        return Epsilon() if minimum == 0 else regex
+    elif minimum == maximum == 1:
+        return regex
+    elif minimum == 0 and maximum is None:
+        return repeat(regex)
+    return CountedRepetition(regex, minimum, maximum)
+
+
+def normalize(regex):
+    """
+    Returns a regex equivalent to the given one, constructed using
+    :func:`concatenate`, :func:`union` and :func:`repeat`, without groups.
+    """
+    if isinstance(regex, Concatenation):
+        return concatenate(*map(normalize, regex.operands))
+    elif isinstance(regex, Union):
+        return union(*map(normalize, regex.operands))
+    elif isinstance(regex, Repetition):
+        return repeat(normalize(regex.repeated))
+    elif isinstance(regex, CountedRepetition):
+        return count(normalize(regex.repeated), regex.minimum, regex.maximum)
+    elif isinstance(regex, Group):
+        return normalize(regex.grouped)
+    return regex
@@ -0,0 +1,159 @@
+# coding: utf-8
+"""
+    regex.background
+    ~~~~~~~~~~~~~~~~
+
+    Compiles regexes in a pool of threads or processes, so that creating
+    matchers - e.g. for the definitions of a tokenizer - does not block the
+    caller until every automaton has been constructed.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+from regex.parser import parse
+from regex.matcher import MatcherBase
+
+
+#: The pool used, if no pool is given, created when it is first needed.
+_default_pool = None
+_default_pool_lock = Lock()
+
+
+def get_default_pool():
+    """
+    Returns a :class:`ThreadPool` with a single thread, that is shared by
+    all matchers compiled in the background without an explicit pool.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ThreadPool(1)
+    return _default_pool
+
+
+def _compile(regex):
+    if isinstance(regex, basestring):
+        regex = parse(regex)
+    return regex.compile()
+
+
+def _compile_unstarted(matcher):
+    # compiles the regex of the matcher in a thread of the pool, unless
+    # waiting for the matcher has started compiling it already
+    with matcher._lock:
+        if matcher._started:
+            return None
+        matcher._started = True
+    return _compile(matcher.regex)
+
+
+class BackgroundMatcher(MatcherBase):
+    """
+    A matcher for `regex`, that is compiled by `pool` - a
+    :class:`multiprocessing.pool.ThreadPool` or
+    :class:`multiprocessing.Pool` - in the background.
+
+    Until the compiled matcher is available, an NFA is used instead, which
+    is constructed much faster. If `fallback` is false, using the matcher
+    waits for the compilation to finish instead. If a pool of threads has
+    not started compiling the regex yet, it is compiled right away by the
+    waiting thread, instead of waiting for the regexes submitted before it.
+    A pool of processes always finishes the earlier regexes first.
+
+    The regex is parsed immediately, so that invalid regexes raise a
+    :exc:`regex.parser.ParserError` right away. As regexes cannot be pickled,
+    `regex` has to be a string, if `pool` is a pool of processes.
+
+    :param regex: A regex string or :class:`regex.ast.Regex` object.
+    """
+    def __init__(self, regex, pool=None, fallback=True):
+        if pool is None:
+            pool = get_default_pool()
+        task = regex
+        if isinstance(regex, basestring):
+            regex = parse(regex)
+        elif not isinstance(pool, ThreadPool):
+            raise TypeError(
+                "regex has to be a string, to be compiled by processes"
+            )
+        self.regex = regex
+        self.fallback = fallback
+        self._compiled = None
+        self._nfa = None
+        self._lock = Lock()
+        if isinstance(pool, ThreadPool):
+            # threads share the parsed regex and the matcher, so a waiting
+            # thread can take over the compilation, if it has not started
+            self._started = False
+            self._result = pool.apply_async(_compile_unstarted, (self, ))
+        else:
+            # processes parse the regex again
+            self._started = True
+            self._result = pool.apply_async(_compile, (task, ))
+
+    @property
+    def is_compiled(self):
+        """
+        `True` if the compiled matcher is available, `False` while it is
+        being compiled and if compiling it failed.
+        """
+        if self._compiled is not None:
+            return True
+        return (
+            self._result.ready() and
+            self._result.successful() and
+            self._result.get() is not None
+        )
+
+    def wait(self):
+        """
+        Waits until the regex is compiled and returns the compiled matcher.
+        Exceptions raised while compiling are raised here.
+        """
+        if self._compiled is None:
+            with self._lock:
+                if self._compiled is None:
+                    if self._started:
+                        self._compiled = self._result.get()
+                    else:
+                        self._started = True
+                        try:
+                            self._compiled = _compile(self.regex)
+                        except:
+                            # the next call compiles it again and raises
+                            self._started = False
+                            raise
+                self._nfa = None
+        return self._compiled
+
+    @property
+    def matcher(self):
+        """
+        The matcher used for matching: the compiled matcher, if it is
+        available, otherwise the NFA or - without a fallback - the compiled
+        matcher, once it is available.
+        """
+        if self._compiled is not None:
+            return self._compiled
+        if self._result.ready() or not self.fallback:
+            return self.wait()
+        if self._nfa is None:
+            self._nfa = self.regex.optimize().to_nfa()
+        return self._nfa
+
+    def match(self, string, pos=0, endpos=None):
+        return self.matcher.match(string, pos, endpos)
+
+    def find(self, string, pos=0, endpos=None):
+        return self.matcher.find(string, pos, endpos)
+
+
+def compile_in_background(regexes, pool=None, fallback=True):
+    """
+    Returns a list of :class:`BackgroundMatcher`\\s for `regexes`, whose
+    compilation is started immediately.
+    """
+    return [BackgroundMatcher(regex, pool, fallback) for regex in regexes]
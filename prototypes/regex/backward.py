@@ -0,0 +1,71 @@
+# coding: utf-8
+"""
+    regex.backward
+    ~~~~~~~~~~~~~~
+
+    Searches backwards from a position in a string, for example to find the
+    previous match before the cursor in an editor, without searching the
+    string from its beginning.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+import sys
+
+from regex.parser import parse
+from regex.ast import Concatenation, Repetition, CharacterClass
+from regex.intervals import IntervalSet
+from regex.matcher import Find, Span
+
+
+class BackwardSearcher(object):
+    """
+    Finds the match of a regex starting closest before a position.
+
+    The string is read backwards from the position with a DFA for the
+    reversed regex, preceded by a repetition of any character. The DFA
+    reaches a final state as soon as it has read a string beginning with a
+    match, so the search stops at the start of the previous match and takes
+    time proportional to the distance to it. Counted repetitions, which are
+    too large for a DFA table, use a :class:`regex.fa.DerivativeDFA`.
+
+    :param regex: A regex string or :class:`regex.ast.Regex` object.
+    """
+    def __init__(self, regex):
+        if isinstance(regex, basestring):
+            regex = parse(regex)
+        regex = regex.optimize()
+        self.matcher = regex.compile()
+        reverse = Concatenation(
+            Repetition(CharacterClass(IntervalSet([(0, sys.maxunicode)]))),
+            regex.reverse()
+        )
+        self.reverse_dfa = reverse.to_searchable_dfa()
+
+    def find_before(self, string, position=None):
+        """
+        Returns `None` or the :class:`Find` of the match with the greatest
+        start before `position`, that ends at or before `position`. The span
+        of the find is the same :meth:`regex.matcher.MatcherBase.find` would
+        return for ``string[:position]``.
+
+        If `position` is `None`, the last match in the string is found.
+        """
+        if position is None:
+            position = len(string)
+        transition = self.reverse_dfa.transition
+        finals = self.reverse_dfa.finals
+        state = 0
+        for start in xrange(position - 1, -1, -1):
+            state = transition(state, string[start])
+            if state is None:
+                return None
+            if state in finals:
+                end = self.matcher.match(string, start, position)
+                # the matcher only reports empty matches at the end of the
+                # string, like a forward search
+                if end is not None:
+                    return Find(string, Span(start, end))
+        return None
+
+    rfind = find_before
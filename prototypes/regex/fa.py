@@ -6,20 +6,64 @@
     :copyright: 2012 by Daniel Neuhäuser
     :license: BSD, see LICENSE.rst
 """
+from array import array
+from itertools import chain, izip
 from collections import deque
 
-from regex.matcher import MatcherBase
+from regex.matcher import MatcherBase, Find, Span, iter_region, get_region
+from regex.intervals import IntervalSet, get_boundaries, to_interval_set
 
 
-def contains_final(states):
-    return any(state.is_final for state in states)
+def iter_bits(bits):
+    """
+    Yields the positions of all bits set in the given integer.
+    """
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
 
 
-def flatten(iterables):
-    result = []
-    for iterable in iterables:
-        result.extend(iterable)
-    return result
+def partition(sets):
+    """
+    Returns a list of disjoint sets, such that every given set is the union
+    of some of them.
+
+    If any of the sets is an :class:`IntervalSet`, all sets are converted to
+    interval sets, so are the returned ones.
+    """
+    if any(isinstance(characters, IntervalSet) for characters in sets):
+        sets = map(to_interval_set, sets)
+    blocks = []
+    for remaining in sets:
+        new_blocks = []
+        for block in blocks:
+            inside = block & remaining
+            if inside:
+                new_blocks.append(inside)
+                remaining = remaining - inside
+                if len(inside) < len(block):
+                    new_blocks.append(block - inside)
+            else:
+                new_blocks.append(block)
+        if remaining:
+            new_blocks.append(remaining)
+        blocks = new_blocks
+    return blocks
+
+
+def add_transition(state, movement, target):
+    """
+    Adds a transition from `state` to `target` for `movement`, which is
+    either a single character or an :class:`IntervalSet`.
+    """
+    if isinstance(movement, IntervalSet):
+        if len(movement) == 1:
+            state.movements[movement.first()] = target
+        else:
+            state.classes.append((movement, target))
+    else:
+        state.movements[movement] = target
 
 
 class NFA(MatcherBase):
@@ -28,52 +72,259 @@ class NFA(MatcherBase):
         self.final = final
 
     def to_dfa(self):
+        self._index()
+        if self._counting:
+            raise ValueError(
+                "NFAs with counters cannot be converted to DFAs"
+            )
         states = {}
-        closure = self.start.epsilon_closure()
+        closure = self._closures[0]
         start = self._get_state_from_closure(closure)
         states[closure] = start
         new_states = deque([(start, closure)])
         final_states = []
-        if contains_final(closure):
+        if closure & self._final_mask:
             final_states.append((closure, start))
+
+        def get_state(closure):
+            if closure == 0:
+                # there is no transition, this is an exception to the
+                # default transition
+                return None
+            if closure not in states:
+                new_state = self._get_state_from_closure(closure)
+                states[closure] = new_state
+                if closure & self._final_mask:
+                    final_states.append((closure, new_state))
+                new_states.append((new_state, closure))
+            return states[closure]
+
         while new_states:
             state, closure = new_states.popleft()
-            for movement, closure in self._get_movements_to_closures(closure).iteritems():
-                if closure not in states:
-                    states[closure] = new_state = self._get_state_from_closure(closure)
-                    if contains_final(closure):
-                        final_states.append((closure, new_state))
-                    new_states.append((new_state, closure))
-                state.movements[movement] = states[closure]
+            (
+                movements, classes, default
+            ) = self._get_movements_to_closures(closure)
+            for movement, target in movements.iteritems():
+                state.movements[movement] = get_state(target)
+            for characters, target in classes:
+                state.classes.append((characters, get_state(target)))
+            state.default = get_state(default)
         return DFA(start, final_states)
 
+    def _index(self):
+        """
+        Assigns an id to every state reachable from the start state and
+        precomputes the epsilon closure of each state as an integer, in which
+        the bit at position `id` is set for every state in the closure.
+
+        The start state always gets the id 0.
+        """
+        if hasattr(self, "_closures"):
+            return
+        states = [self.start]
+        ids = {self.start: 0}
+        i = 0
+        while i < len(states):
+            state = states[i]
+            i += 1
+            for target in chain(
+                state.movements.itervalues(), state.epsilon_moves,
+                (target for _, target in state.classes), [state.default]
+            ):
+                if target is not None and target not in ids:
+                    ids[target] = len(states)
+                    states.append(target)
+        closures = [None] * len(states)
+        for i, state in enumerate(states):
+            closure = 1 << i
+            stack = [state]
+            while stack:
+                for target in stack.pop().epsilon_moves:
+                    j = ids[target]
+                    if closure >> j & 1:
+                        continue
+                    if closures[j] is None:
+                        closure |= 1 << j
+                        stack.append(target)
+                    else:
+                        # the closure of the target is complete and contains
+                        # everything reachable from it, no need to walk it.
+                        closure |= closures[j]
+            closures[i] = closure
+        self._states = states
+        self._ids = ids
+        self._counting = any(state.is_counting for state in states)
+        self._closures = closures
+        self._final_mask = sum(
+            1 << i for i, state in enumerate(states) if state.is_final
+        )
+        self._movements = [
+            dict(
+                (movement, 0 if target is None else closures[ids[target]])
+                for movement, target in state.movements.iteritems()
+            )
+            for state in states
+        ]
+        self._classes = [
+            [
+                (characters, closures[ids[target]])
+                for characters, target in state.classes
+            ]
+            for state in states
+        ]
+        self._defaults = [
+            0 if state.default is None else closures[ids[state.default]]
+            for state in states
+        ]
+
+    def has_counters(self):
+        """
+        Returns `True`, if the NFA contains counting states, in which case
+        it cannot be simulated with closures.
+        """
+        self._index()
+        return self._counting
+
+    def get_start_closure(self):
+        """
+        Returns the epsilon closure of the start state, as an integer in
+        which the bit at the id of every state in the closure is set.
+        """
+        self._index()
+        return self._closures[0]
+
+    def get_state_mask(self, state):
+        """
+        Returns an integer in which only the bit at the id of `state` is
+        set, or 0 if `state` is not reachable from the start state.
+        """
+        self._index()
+        if state not in self._ids:
+            return 0
+        return 1 << self._ids[state]
+
+    def move_closure(self, closure, movement):
+        """
+        Returns the closure reached from `closure` by `movement`.
+        """
+        return self._move(closure, movement)
+
     def _get_state_from_closure(self, closure):
-        return DFAState(final=any(state.is_final for state in closure))
+        return DFAState(final=bool(closure & self._final_mask))
 
     def _get_movements_to_closures(self, closure):
-        movements = {}
-        for closed_state in closure:
-            for movement, transition_state in closed_state.movements.iteritems():
-                if movement in movements:
-                    movements[movement] |= transition_state.epsilon_closure()
-                else:
-                    movements[movement] = transition_state.epsilon_closure()
-        return movements
+        """
+        Returns the transitions of the DFA state for `closure`: a dictionary
+        mapping the movements the states in `closure` have an explicit
+        transition for to the closures they lead to, a list of
+        ``(characters, closure)`` pairs for the character classes - disjoint
+        :class:`IntervalSet`\s - and the closure all other movements lead
+        to. Transitions equivalent to the less specific ones are omitted.
+        """
+        default = 0
+        movements = set()
+        character_sets = []
+        for i in iter_bits(closure):
+            default |= self._defaults[i]
+            movements.update(self._movements[i])
+            character_sets.extend(
+                characters for characters, _ in self._classes[i]
+            )
+        classes = {}
+        if character_sets:
+            boundaries = get_boundaries(character_sets)
+            for start, end in zip(boundaries, boundaries[1:]):
+                target_closure = self._move_by_class(closure, unichr(start))
+                if target_closure != default:
+                    classes.setdefault(target_closure, []).append(
+                        (start, end - 1)
+                    )
+        result = {}
+        for movement in movements:
+            target_closure = self._move(closure, movement)
+            if target_closure != self._move_by_class(closure, movement):
+                result[movement] = target_closure
+        return result, [
+            (IntervalSet(intervals), target_closure)
+            for target_closure, intervals in classes.iteritems()
+        ], default
 
-    def match(self, string):
-        states = [self.start]
-        last_successful_end = 0 if contains_final(states) else None
-        for i, character in enumerate(string, 1):
-            states = flatten(state.transition(character) for state in states)
-            if contains_final(states):
+    def match(self, string, pos=0, endpos=None):
+        pos, endpos = get_region(string, pos, endpos)
+        self._index()
+        if self._counting:
+            return self._match_counting(string, pos, endpos)
+        closure = self._closures[0]
+        last_successful_end = None
+        for i, character in iter_region(string, pos, endpos):
+            closure = self._move(closure, character)
+            if not closure:
+                break
+            if closure & self._final_mask:
                 last_successful_end = i
-            elif not states:
+        else:
+            if last_successful_end is None and closure & self._final_mask:
+                last_successful_end = pos
+        return last_successful_end
+
+    def _match_counting(self, string, pos, endpos):
+        # simulates the NFA using configurations, each being a state and a
+        # tuple of the counters of the counted repetitions it is in.
+        configurations = self._get_counting_closure([(self.start, ())])
+        last_successful_end = None
+        for i, character in iter_region(string, pos, endpos):
+            configurations = self._get_counting_closure(
+                (state.move(character), counters)
+                for state, counters in configurations
+                if state.move(character) is not None
+            )
+            if not configurations:
                 break
-        states = flatten(state.epsilon_transition() for state in states)
-        if contains_final(states):
-            last_successful_end = len(string)
+            if any(state.is_final for state, _ in configurations):
+                last_successful_end = i
+        else:
+            if last_successful_end is None and any(
+                state.is_final for state, _ in configurations
+            ):
+                last_successful_end = pos
         return last_successful_end
 
+    def _get_counting_closure(self, configurations):
+        result = set(configurations)
+        stack = list(result)
+        while stack:
+            state, counters = stack.pop()
+            for configuration in state.epsilon_configurations(counters):
+                if configuration not in result:
+                    result.add(configuration)
+                    stack.append(configuration)
+        return result
+
+    def _move(self, closure, movement):
+        result = 0
+        for i in iter_bits(closure):
+            movements = self._movements[i]
+            if movement in movements:
+                result |= movements[movement]
+            else:
+                result |= self._get_class_closure(i, movement)
+        return result
+
+    def _move_by_class(self, closure, movement):
+        # like _move but ignoring the explicit transitions, this is the
+        # closure the DFA state for `closure` moves to, if it has no explicit
+        # transition for `movement`
+        result = 0
+        for i in iter_bits(closure):
+            result |= self._get_class_closure(i, movement)
+        return result
+
+    def _get_class_closure(self, i, movement):
+        for characters, target_closure in self._classes[i]:
+            if movement in characters:
+                return target_closure
+        return self._defaults[i]
+
     def __repr__(self):
         return "%s(%r, %r)" % (
             self.__class__.__name__,
@@ -82,34 +333,423 @@ class NFA(MatcherBase):
         )
 
 
+class TaggedNFA(NFA):
+    """
+    An NFA that reports the spans of the groups in a match, along with the
+    match itself.
+
+    The NFA is simulated with one thread per state, as described by Pike,
+    each thread carrying the positions recorded at the :class:`TagState`\s it
+    passed. Threads are kept in order of priority, if several threads reach
+    the same state only the one with the highest priority survives. That way
+    the groups of a match are found in the same single pass over the string
+    that finds the match.
+
+    :param groups: The number of groups.
+    """
+    def __init__(self, start, final, groups):
+        NFA.__init__(self, start, final)
+        self.groups = groups
+
+    def match(self, string, pos=0, endpos=None):
+        return self.match_groups(string, pos, endpos)[0]
+
+    def match_groups(self, string, pos=0, endpos=None):
+        """
+        Returns the end of the match as returned by :meth:`match` and a tuple
+        with a :class:`Span` or `None` for each group.
+        """
+        pos, endpos = get_region(string, pos, endpos)
+        threads = self._follow(
+            [(self.start, (), (None, ) * (2 * self.groups))], pos
+        )
+        last_successful_end = last_positions = None
+        for i, character in iter_region(string, pos, endpos):
+            threads = self._follow([
+                (state.move(character), counters, positions)
+                for state, counters, positions in threads
+                if state.move(character) is not None
+            ], i)
+            if not threads:
+                break
+            for state, _, positions in threads:
+                if state.is_final:
+                    last_successful_end, last_positions = i, positions
+                    break
+        else:
+            if last_successful_end is None:
+                for state, _, positions in threads:
+                    if state.is_final:
+                        last_successful_end, last_positions = pos, positions
+                        break
+        if last_successful_end is None:
+            return None, None
+        return last_successful_end, tuple(
+            None if start is None or end is None else Span(start, end)
+            for start, end in izip(last_positions[::2], last_positions[1::2])
+        )
+
+    def _follow(self, threads, position):
+        # follows the epsilon moves of the threads depth first, in the order
+        # of their priority
+        result = []
+        seen = set()
+        stack = threads[::-1]
+        while stack:
+            state, counters, positions = stack.pop()
+            if (state, counters) in seen:
+                continue
+            seen.add((state, counters))
+            if isinstance(state, TagState):
+                positions = (
+                    positions[:state.tag] + (position, ) +
+                    positions[state.tag + 1:]
+                )
+            if state.has_transitions or state.is_final:
+                result.append((state, counters, positions))
+            for target, target_counters in reversed(
+                state.epsilon_configurations(counters)
+            ):
+                stack.append((target, target_counters, positions))
+        return result
+
+    def _find_at(self, string, pos, endpos):
+        end, groups = self.match_groups(string, pos, endpos)
+        if end is not None:
+            return Find(string, Span(pos, end), groups)
+
+
+class PositionAutomaton(MatcherBase):
+    """
+    An NFA without epsilon moves, that has one state per position - an
+    occurrence of a character set - in a regex and an initial state, which
+    always has the position 0.
+
+    Sets of states are represented as integers, in which the bit at the
+    position of each state in the set is set.
+
+    :param characters: A list of character sets, one for each position.
+    :param follow: A list containing the positions, that can follow each
+                   position.
+    :param final_mask: The set of positions that can end a match.
+    """
+    def __init__(self, characters, follow, final_mask):
+        self.characters = characters
+        self.follow = follow
+        self.final_mask = final_mask
+        self._character_masks = {}
+
+    def _get_character_mask(self, character):
+        try:
+            return self._character_masks[character]
+        except KeyError:
+            mask = self._character_masks[character] = sum(
+                1 << position
+                for position, characters in enumerate(self.characters)
+                if character in characters
+            )
+            return mask
+
+    def _get_follow(self, positions):
+        result = 0
+        for position in iter_bits(positions):
+            result |= self.follow[position]
+        return result
+
+    def to_dfa(self):
+        start = DFAState(final=bool(self.final_mask & 1))
+        states = {1: start}
+        new_states = deque([(start, 1)])
+        final_states = []
+        if start.is_final:
+            final_states.append((1, start))
+        while new_states:
+            state, positions = new_states.popleft()
+            follow = self._get_follow(positions)
+            character_sets = [
+                self.characters[position] for position in iter_bits(follow)
+            ]
+            if any(
+                isinstance(characters, IntervalSet)
+                for characters in character_sets
+            ):
+                movements = [
+                    (
+                        characters,
+                        follow & self._get_character_mask(characters.first())
+                    )
+                    for characters in partition(character_sets)
+                ]
+            else:
+                movements = {}
+                for position in iter_bits(follow):
+                    for character in self.characters[position]:
+                        movements[character] = (
+                            movements.get(character, 0) | 1 << position
+                        )
+                movements = movements.iteritems()
+            for movement, positions in movements:
+                if positions not in states:
+                    states[positions] = new_state = DFAState(
+                        final=bool(positions & self.final_mask)
+                    )
+                    if new_state.is_final:
+                        final_states.append((positions, new_state))
+                    new_states.append((new_state, positions))
+                add_transition(state, movement, states[positions])
+        return DFA(start, final_states)
+
+    def match(self, string, pos=0, endpos=None):
+        pos, endpos = get_region(string, pos, endpos)
+        positions = 1
+        last_successful_end = None
+        for i, character in iter_region(string, pos, endpos):
+            positions = (
+                self._get_follow(positions) &
+                self._get_character_mask(character)
+            )
+            if not positions:
+                break
+            if positions & self.final_mask:
+                last_successful_end = i
+        else:
+            if last_successful_end is None and positions & self.final_mask:
+                last_successful_end = pos
+        return last_successful_end
+
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (
+            self.__class__.__name__,
+            self.characters,
+            self.follow,
+            self.final_mask
+        )
+
+
+#: The number of positions, whose follow sets are combined in one table of
+#: a :class:`BitParallelNFA`.
+FOLLOW_TABLE_BITS = 8
+
+
+class BitParallelNFA(PositionAutomaton):
+    """
+    A :class:`PositionAutomaton`, that computes the positions following a
+    set of positions with table lookups, instead of one lookup per position
+    in the set.
+
+    The positions are split into blocks of :data:`FOLLOW_TABLE_BITS`
+    positions, for each block a table maps every subset of the positions in
+    it to the union of their follow sets. Constructing the tables is cheap
+    compared to constructing a DFA, which makes this suitable for regexes
+    with up to a few hundred positions, that are used only a few times.
+    """
+    def __init__(self, characters, follow, final_mask):
+        PositionAutomaton.__init__(self, characters, follow, final_mask)
+        self._follow_tables = []
+        for offset in xrange(0, len(follow), FOLLOW_TABLE_BITS):
+            size = 1 << min(FOLLOW_TABLE_BITS, len(follow) - offset)
+            table = [0] * size
+            for positions in xrange(1, size):
+                lowest = positions & -positions
+                table[positions] = (
+                    table[positions ^ lowest] |
+                    follow[offset + lowest.bit_length() - 1]
+                )
+            self._follow_tables.append(table)
+
+    def _get_follow(self, positions):
+        result = 0
+        block_mask = (1 << FOLLOW_TABLE_BITS) - 1
+        for table in self._follow_tables:
+            if not positions:
+                break
+            result |= table[positions & block_mask]
+            positions >>= FOLLOW_TABLE_BITS
+        return result
+
+    def match(self, string, pos=0, endpos=None):
+        pos, endpos = get_region(string, pos, endpos)
+        follow_tables = self._follow_tables
+        block_mask = (1 << FOLLOW_TABLE_BITS) - 1
+        character_masks = self._character_masks
+        final_mask = self.final_mask
+        positions = 1
+        last_successful_end = None
+        for i, character in iter_region(string, pos, endpos):
+            mask = character_masks.get(character)
+            if mask is None:
+                mask = self._get_character_mask(character)
+            # inlined _get_follow
+            follow = 0
+            for table in follow_tables:
+                follow |= table[positions & block_mask]
+                positions >>= FOLLOW_TABLE_BITS
+                if not positions:
+                    break
+            positions = follow & mask
+            if not positions:
+                break
+            if positions & final_mask:
+                last_successful_end = i
+        else:
+            if last_successful_end is None and positions & final_mask:
+                last_successful_end = pos
+        return last_successful_end
+
+
+class DerivativeDFA(MatcherBase):
+    """
+    A DFA whose states are regular expressions. The transitions of a state
+    lead to the derivatives of its regex and are only computed, when they
+    are needed to match a string, so no automaton has to be constructed
+    upfront.
+
+    Like a :class:`DFATable` it can be driven with :meth:`transition`, the
+    start state has the id 0 and the ids of the final states reached so far
+    are in `finals`.
+
+    :param start: The regex to match.
+    :param empty: The regex matching nothing, which is used as dead state.
+    """
+    def __init__(self, start, empty):
+        self.start = start
+        self.empty = empty
+        self.finals = set()
+        self._state_ids = {}
+        self._states = []
+        self._movements = []
+        self._start = self._get_state_id(start)
+        self._dead = self._get_state_id(empty)
+
+    def _get_state_id(self, regex):
+        try:
+            return self._state_ids[regex]
+        except KeyError:
+            self._state_ids[regex] = state_id = len(self._states)
+            self._states.append(regex)
+            if regex.is_nullable():
+                self.finals.add(state_id)
+            self._movements.append({})
+            return state_id
+
+    def transition(self, state, character):
+        """
+        Returns the id of the state `character` leads to from the state with
+        the id `state` or `None`, if it leads to the dead state.
+        """
+        target = self._transition(state, character)
+        if target == self._dead:
+            return None
+        return target
+
+    def _transition(self, state_id, character):
+        movements = self._movements[state_id]
+        try:
+            return movements[character]
+        except KeyError:
+            target = movements[character] = self._get_state_id(
+                self._states[state_id].derive(character)
+            )
+            return target
+
+    def to_dfa(self):
+        """
+        Returns a :class:`DFA` containing all states of this automaton.
+        """
+        start = DFAState(final=self.start.is_nullable())
+        states = {self.start: start}
+        new_states = deque([(start, self.start)])
+        final_states = []
+        if start.is_final:
+            final_states.append((self.start, start))
+        while new_states:
+            state, regex = new_states.popleft()
+            for characters in partition(regex.first_characters()):
+                if isinstance(characters, IntervalSet):
+                    derivative = regex.derive(characters.first())
+                else:
+                    derivative = regex.derive(next(iter(characters)))
+                if derivative == self.empty:
+                    continue
+                if derivative not in states:
+                    states[derivative] = new_state = DFAState(
+                        final=derivative.is_nullable()
+                    )
+                    if new_state.is_final:
+                        final_states.append((derivative, new_state))
+                    new_states.append((new_state, derivative))
+                if isinstance(characters, IntervalSet):
+                    add_transition(state, characters, states[derivative])
+                else:
+                    for character in characters:
+                        state.movements[character] = states[derivative]
+        return DFA(start, final_states)
+
+    def match(self, string, pos=0, endpos=None):
+        pos, endpos = get_region(string, pos, endpos)
+        state = self._start
+        last_successful_end = None
+        for i, character in iter_region(string, pos, endpos):
+            state = self._transition(state, character)
+            if state == self._dead:
+                break
+            if state in self.finals:
+                last_successful_end = i
+        else:
+            if last_successful_end is None and state in self.finals:
+                last_successful_end = pos
+        return last_successful_end
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (
+            self.__class__.__name__,
+            self.start,
+            self.empty
+        )
+
+
 class DFA(MatcherBase):
     def __init__(self, start, finals):
         self.start = start
         self.finals = finals
 
     def to_dfa_table(self):
-        table = [{}]
-        state_ids = {self.start: 0}
+        table = []
+        classes = []
+        defaults = []
+        state_ids = {None: None}
         final_ids = set()
-        if self.start.is_final:
-            final_ids.add(0)
-        new_states = deque([self.start])
+        new_states = deque()
+
+        def get_state_id(state):
+            if state not in state_ids:
+                state_ids[state] = state_id = len(table)
+                table.append({})
+                classes.append([])
+                defaults.append(None)
+                if state.is_final:
+                    final_ids.add(state_id)
+                new_states.append(state)
+            return state_ids[state]
+
+        get_state_id(self.start)
         while new_states:
             state = new_states.popleft()
+            state_id = state_ids[state]
             for movement, transition_state in state.movements.iteritems():
-                if transition_state not in state_ids:
-                    table.append({})
-                    state_ids[transition_state] = state_id = len(table) - 1
-                    if transition_state.is_final:
-                        final_ids.add(state_id)
-                    new_states.append(transition_state)
-                table[state_ids[state]][movement] = state_ids[transition_state]
-        return DFATable(table, final_ids)
-
-    def match(self, string):
+                table[state_id][movement] = get_state_id(transition_state)
+            for characters, transition_state in state.classes:
+                classes[state_id].append(
+                    (characters, get_state_id(transition_state))
+                )
+            defaults[state_id] = get_state_id(state.default)
+        return DFATable(table, final_ids, defaults, classes)
+
+    def match(self, string, pos=0, endpos=None):
+        pos, endpos = get_region(string, pos, endpos)
         state = self.start
         last_successful_end = None
-        for i, character in enumerate(string, 1):
+        for i, character in iter_region(string, pos, endpos):
             state = state.transition(character)
             if state is None:
                 break
@@ -117,7 +757,7 @@ class DFA(MatcherBase):
                 last_successful_end = i
         else:
             if last_successful_end is None and state.is_final:
-                last_successful_end = 0
+                last_successful_end = pos
         return last_successful_end
 
     def __repr__(self):
@@ -129,26 +769,172 @@ class DFA(MatcherBase):
 
 
 class DFATable(MatcherBase):
-    def __init__(self, table, finals):
+    """
+    A DFA represented by a list of dictionaries, one for each state, that
+    map movements to the ids of the states they lead to or `None`, if there
+    is no transition. Movements not in the dictionary lead to the state of
+    the first class containing them, given in `classes` - a list with a list
+    of ``(characters, state_id)`` pairs for each state - or otherwise to the
+    default state given in `defaults` - a list with a state id or `None` for
+    each state.
+    """
+    def __init__(self, table, finals, defaults=None, classes=None):
         self.table = table
         self.finals = finals
+        if defaults is None:
+            defaults = [None] * len(table)
+        self.defaults = defaults
+        if classes is None:
+            classes = [[] for _ in table]
+        self.classes = classes
+
+    def transition(self, state, character):
+        """
+        Returns the id of the state `character` leads to from the state with
+        the id `state` or `None`.
+        """
+        inputs = self.table[state]
+        if character in inputs:
+            return inputs[character]
+        for characters, target in self.classes[state]:
+            if character in characters:
+                return target
+        return self.defaults[state]
 
-    def match(self, string):
+    def match(self, string, pos=0, endpos=None):
+        pos, endpos = get_region(string, pos, endpos)
+        table = self.table
+        classes = self.classes
+        defaults = self.defaults
         state = 0
         last_successful_end = None
-        for i, character in enumerate(string, 1):
-            inputs = self.table[state]
-            try:
+        for i, character in iter_region(string, pos, endpos):
+            inputs = table[state]
+            if character in inputs:
                 state = inputs[character]
-            except KeyError:
+            elif classes[state]:
+                state = self.transition(state, character)
+            else:
+                state = defaults[state]
+            if state is None:
                 break
             if state in self.finals:
                 last_successful_end = i
         else:
             if last_successful_end is None and state in self.finals:
-                last_successful_end = 0
+                last_successful_end = pos
         return last_successful_end
 
+    def compress(self, chain=False):
+        """
+        Returns an equivalent :class:`CompressedDFATable`. If `chain` is
+        true, rows are stored as differences to similar rows, where that
+        makes them smaller. This pays off for tables with many similar rows
+        - like those of identifiers - while the chain of every state takes
+        an entry of its own.
+        """
+        characters = sorted(set(
+            character for inputs in self.table for character in inputs
+        ))
+        columns = dict(
+            (character, i) for i, character in enumerate(characters)
+        )
+        rows = [
+            dict(
+                (columns[character], NO_STATE if target is None else target)
+                for character, target in inputs.iteritems()
+            )
+            for inputs in self.table
+        ]
+        chains = [NO_STATE] * len(rows)
+        if chain:
+            # only rows sharing entries with a row can make it smaller, they
+            # are found through the rows sharing each entry, considering the
+            # most recent ones only.
+            sharing = {}
+            for state, row in enumerate(rows):
+                shared = {}
+                for entry in row.iteritems():
+                    candidates = sharing.get(entry, [])
+                    for other in candidates[-MAX_CHAIN_CANDIDATES:]:
+                        shared[other] = shared.get(other, 0) + 1
+                best, best_size = None, len(row)
+                for other, count in shared.iteritems():
+                    size = len(row) + len(rows[other]) - 2 * count
+                    if size < best_size:
+                        best, best_size = other, size
+                if best is None:
+                    for entry in row.iteritems():
+                        sharing.setdefault(entry, []).append(state)
+                    continue
+                other_row = rows[best]
+                difference = dict(
+                    (column, target) for column, target in row.iteritems()
+                    if other_row.get(column) != target
+                )
+                for column in other_row:
+                    if column not in row:
+                        difference[column] = NOT_IN_ROW
+                rows[state], chains[state] = difference, best
+        base = array("i", [0] * len(rows))
+        next = array("i")
+        check = array("i")
+        # free[i] is i for free entries, taken entries point to a later one,
+        # so that the first free entry at or after i is found by following
+        # them.
+        free = []
+
+        def find_free(i):
+            start = i
+            while i < len(free) and free[i] != i:
+                i = free[i]
+            while start < i and free[start] != i:
+                free[start], start = i, free[start]
+            return i
+
+        # rows are placed first fit, the largest first, at an offset at
+        # which none of their entries collide with those of placed rows.
+        # Only offsets at which the first entry of a row is free are tried.
+        for state in sorted(xrange(len(rows)), key=lambda s: -len(rows[s])):
+            row = rows[state]
+            if not row:
+                continue
+            row_columns = sorted(row)
+            position = find_free(row_columns[0])
+            while any(
+                position + column - row_columns[0] < len(check) and
+                check[position + column - row_columns[0]] != NO_STATE
+                for column in row_columns[1:]
+            ):
+                position = find_free(position + 1)
+            offset = position - row_columns[0]
+            missing = offset + row_columns[-1] + 1 - len(check)
+            if missing > 0:
+                free.extend(xrange(len(check), len(check) + missing))
+                next.extend([NO_STATE] * missing)
+                check.extend([NO_STATE] * missing)
+            for column, target in row.iteritems():
+                next[offset + column] = target
+                check[offset + column] = state
+                free[offset + column] = offset + column + 1
+            base[state] = offset
+        # every base plus column is a valid index, lookups need no bounds
+        # checks
+        missing = max(base) + len(columns) - len(check) if rows else 0
+        if missing > 0:
+            next.extend([NO_STATE] * missing)
+            check.extend([NO_STATE] * missing)
+        return CompressedDFATable(
+            columns, base, next, check, self.finals,
+            [NO_STATE if state is None else state for state in self.defaults],
+            [
+                [(characters, NO_STATE if target is None else target)
+                 for characters, target in classes]
+                for classes in self.classes
+            ],
+            array("i", chains) if chain else None
+        )
+
     def __repr__(self):
         return "%s(%r, %r)" % (
             self.__class__.__name__,
@@ -157,23 +943,162 @@ class DFATable(MatcherBase):
         )
 
 
+#: Marks the absence of a state in the arrays of a
+#: :class:`CompressedDFATable`.
+NO_STATE = -1
+
+#: Marks a movement, that is not in the row of a state in a
+#: :class:`CompressedDFATable`, in the difference to the row it is chained
+#: to.
+NOT_IN_ROW = -2
+
+#: The number of rows sharing an entry, that are considered when looking for
+#: a row to chain a row of a :class:`CompressedDFATable` to.
+MAX_CHAIN_CANDIDATES = 32
+
+
+class CompressedDFATable(MatcherBase):
+    """
+    A :class:`DFATable` whose movements are stored compressed by row
+    displacement, as in the tables generated by lex and yacc.
+
+    Every character occurring in a movement is given a column by `columns`.
+    The row of each state is stored in `next` at the offset given by `base`,
+    rows overlap as long as their entries do not, `check` contains the state
+    owning each entry. The movement of a `character` in a `state` is
+    therefore ``next[base[state] + column]``, if `check` at that index is the
+    state.
+
+    If `chains` is given, the row of a state with a chained state contains
+    only the entries differing from the row of the chained state, which is
+    looked up otherwise. Chains have a length of at most one, so lookups
+    take constant time.
+
+    Movements not in the row of a state are looked up in `classes` and
+    `defaults` like in a :class:`DFATable`. Missing states are represented
+    by :data:`NO_STATE` throughout.
+    """
+    def __init__(self, columns, base, next, check, finals, defaults, classes,
+                 chains=None):
+        self.columns = columns
+        self.base = base
+        self.next = next
+        self.check = check
+        self.finals = finals
+        self.defaults = defaults
+        self.classes = classes
+        self.chains = chains
+
+    def transition(self, state, character):
+        """
+        Returns the id of the state `character` leads to from the state with
+        the id `state` or `None`.
+        """
+        target = self._transition(state, character)
+        return None if target == NO_STATE else target
+
+    def _transition(self, state, character):
+        column = self.columns.get(character)
+        if column is not None:
+            index = self.base[state] + column
+            if self.check[index] == state:
+                target = self.next[index]
+                if target != NOT_IN_ROW:
+                    return target
+            elif self.chains is not None and self.chains[state] != NO_STATE:
+                chained = self.chains[state]
+                index = self.base[chained] + column
+                if self.check[index] == chained:
+                    return self.next[index]
+        for characters, target in self.classes[state]:
+            if character in characters:
+                return target
+        return self.defaults[state]
+
+    def match(self, string, pos=0, endpos=None):
+        pos, endpos = get_region(string, pos, endpos)
+        columns = self.columns
+        base = self.base
+        next = self.next
+        check = self.check
+        state = 0
+        last_successful_end = None
+        for i, character in iter_region(string, pos, endpos):
+            column = columns.get(character)
+            if column is not None and check[base[state] + column] == state:
+                target = next[base[state] + column]
+                if target == NOT_IN_ROW:
+                    target = self._transition(state, character)
+            else:
+                target = self._transition(state, character)
+            if target == NO_STATE:
+                break
+            state = target
+            if state in self.finals:
+                last_successful_end = i
+        else:
+            if last_successful_end is None and state in self.finals:
+                last_successful_end = pos
+        return last_successful_end
+
+    def get_size(self):
+        """
+        Returns the number of entries in the arrays of this table.
+        """
+        size = len(self.base) + len(self.next) + len(self.check)
+        if self.chains is not None:
+            size += len(self.chains)
+        return size
+
+
 class DFAState(object):
-    def __init__(self, movements=None, final=False):
+    """
+    A state of an automaton, `movements` maps movements to the states they
+    lead to or to `None` if there is no transition. Movements without an
+    entry lead to the state of the first of the `classes` - a list of
+    ``(characters, state)`` pairs with an :class:`IntervalSet` of characters
+    - containing it or otherwise to the `default` state, if there is one.
+    Transitions for any character or large classes of characters are
+    therefore cheap to represent.
+    """
+    def __init__(self, movements=None, final=False, default=None,
+                 classes=None):
         self.movements = {} if movements is None else movements
         self.is_final = final
+        self.default = default
+        self.classes = [] if classes is None else classes
+
+    @property
+    def has_transitions(self):
+        return bool(
+            self.movements or self.classes or self.default is not None
+        )
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return (
                 self.movements == other.movements and
-                self.is_final == other.is_final
+                self.is_final == other.is_final and
+                self.default == other.default and
+                self.classes == other.classes
             )
 
     def __ne__(self, other):
         return not self == other
 
+    def move(self, movement):
+        """
+        Returns the state `movement` leads to or `None`.
+        """
+        if movement in self.movements:
+            return self.movements[movement]
+        for characters, state in self.classes:
+            if movement in characters:
+                return state
+        return self.default
+
     def transition(self, movement):
-        return self.movements.get(movement, None)
+        return self.move(movement)
 
     def __repr__(self):
         return "%s(%r, %r)" % (
@@ -184,22 +1109,35 @@ class DFAState(object):
 
 
 class NFAState(DFAState):
-    def __init__(self, movements=None, final=False, epsilon_moves=None):
-        DFAState.__init__(self, movements, final)
+    is_counting = False
+
+    def __init__(self, movements=None, final=False, epsilon_moves=None,
+                 default=None, classes=None):
+        DFAState.__init__(self, movements, final, default, classes)
         self.epsilon_moves = [] if epsilon_moves is None else epsilon_moves
 
+    def epsilon_configurations(self, counters):
+        """
+        Returns the configurations - pairs of a state and a tuple of counters
+        - reachable with a single epsilon move from this state, given the
+        `counters` of the counted repetitions this state is in.
+        """
+        return [(state, counters) for state in self.epsilon_moves]
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return (
                 self.movements == other.movements and
                 self.is_final == other.is_final and
+                self.default == other.default and
+                self.classes == other.classes and
                 self.epsilon_moves == other.epsilon_moves
             )
         return NotImplemented
 
     def transition(self, movement):
         states = []
-        state = DFAState.transition(self, movement)
+        state = self.move(movement)
         if state is not None:
             states.extend(state._transitioned())
         for state in self.epsilon_transition():
@@ -208,28 +1146,32 @@ class NFAState(DFAState):
 
     def _transitioned(self):
         result = []
-        if self.is_final or self.movements:
-            result.append(self)
-        else:
-            for state in self.epsilon_moves:
-                result.extend(state._transitioned())
+        seen = set([self])
+        stack = [self]
+        while stack:
+            state = stack.pop()
+            if state.is_final or state.has_transitions:
+                result.append(state)
+            else:
+                for target in reversed(state.epsilon_moves):
+                    if target not in seen:
+                        seen.add(target)
+                        stack.append(target)
         return result
 
-    def epsilon_transition(self, excluding=None):
-        states = set() if excluding is None else excluding
-        for state in self.epsilon_moves:
-            if state not in states:
-                states.add(state)
-                states.update(state.epsilon_transition(states))
+    def epsilon_transition(self):
+        states = set()
+        stack = [self]
+        while stack:
+            for state in stack.pop().epsilon_moves:
+                if state not in states:
+                    states.add(state)
+                    stack.append(state)
         return states
 
-    def epsilon_closure(self, excluding=None):
-        states = set() if excluding is None else excluding
+    def epsilon_closure(self):
+        states = self.epsilon_transition()
         states.add(self)
-        for state in self.epsilon_moves:
-            if state not in states:
-                states.add(state)
-                states.update(state.epsilon_closure(states))
         return frozenset(states)
 
     def __repr__(self):
@@ -239,3 +1181,76 @@ class NFAState(DFAState):
             self.is_final,
             self.epsilon_moves
         )
+
+
+class CounterStartState(NFAState):
+    """
+    Enters a counted repetition, by starting a new counter.
+
+    :param repeated: The start state of the repeated NFA.
+    :param exit: The state following the counted repetition.
+    :param minimum: The minimum number of repetitions.
+    """
+    is_counting = True
+
+    def __init__(self, repeated, exit, minimum):
+        epsilon_moves = [repeated]
+        if minimum == 0:
+            epsilon_moves.append(exit)
+        NFAState.__init__(self, epsilon_moves=epsilon_moves)
+        self.repeated = repeated
+        self.exit = exit
+        self.minimum = minimum
+
+    def epsilon_configurations(self, counters):
+        result = [(self.repeated, counters + (0, ))]
+        if self.minimum == 0:
+            result.append((self.exit, counters))
+        return result
+
+
+class CounterLoopState(NFAState):
+    """
+    Follows the final state of the repeated NFA in a counted repetition,
+    counting the repetition and either repeating again or leaving the
+    repetition, depending on the bounds.
+
+    :param repeated: The start state of the repeated NFA.
+    :param exit: The state following the counted repetition.
+    :param minimum: The minimum number of repetitions.
+    :param maximum: The maximum number of repetitions or `None`.
+    """
+    is_counting = True
+
+    def __init__(self, repeated, exit, minimum, maximum):
+        NFAState.__init__(self, epsilon_moves=[repeated, exit])
+        self.repeated = repeated
+        self.exit = exit
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def epsilon_configurations(self, counters):
+        count = counters[-1] + 1
+        result = []
+        if self.maximum is None:
+            # without an upper bound, counting beyond the minimum makes no
+            # difference.
+            result.append(
+                (self.repeated, counters[:-1] + (min(count, self.minimum), ))
+            )
+        elif count < self.maximum:
+            result.append((self.repeated, counters[:-1] + (count, )))
+        if count >= self.minimum:
+            result.append((self.exit, counters[:-1]))
+        return result
+
+
+class TagState(NFAState):
+    """
+    Records the current position in the slot `tag`, when a
+    :class:`TaggedNFA` passes it. The start of group `n` is recorded in slot
+    ``2 * n``, the end in slot ``2 * n + 1``.
+    """
+    def __init__(self, tag, final=False, epsilon_moves=None):
+        NFAState.__init__(self, final=final, epsilon_moves=epsilon_moves)
+        self.tag = tag
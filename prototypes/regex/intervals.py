@@ -0,0 +1,131 @@
+# coding: utf-8
+"""
+    regex.intervals
+    ~~~~~~~~~~~~~~~
+
+    Sets of characters represented by intervals of code points, so that
+    large sets - like all letters - can be stored and combined without ever
+    enumerating their characters.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+import sys
+from bisect import bisect_right
+
+
+class IntervalSet(object):
+    """
+    An immutable set of characters, given by an iterable of ``(start, end)``
+    code point intervals that include both `start` and `end`. The intervals
+    are sorted and merged, so that equal sets have equal intervals.
+    """
+    def __init__(self, intervals):
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = merged[-1][0], end
+            else:
+                merged.append((start, end))
+        self.intervals = tuple(merged)
+        self._starts = [start for start, _ in merged]
+
+    @classmethod
+    def from_characters(cls, characters):
+        return cls(
+            (ord(character), ord(character)) for character in characters
+        )
+
+    @classmethod
+    def from_range(cls, start, end):
+        return cls([(ord(start), ord(end))])
+
+    def first(self):
+        """
+        Returns the first character in this set.
+        """
+        return unichr(self.intervals[0][0])
+
+    def __contains__(self, character):
+        code = ord(character)
+        i = bisect_right(self._starts, code) - 1
+        return i >= 0 and code <= self.intervals[i][1]
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in self.intervals)
+
+    def __nonzero__(self):
+        return bool(self.intervals)
+
+    def __or__(self, other):
+        return self.__class__(self.intervals + other.intervals)
+
+    def __and__(self, other):
+        result = []
+        i = j = 0
+        while i < len(self.intervals) and j < len(other.intervals):
+            start = max(self.intervals[i][0], other.intervals[j][0])
+            end = min(self.intervals[i][1], other.intervals[j][1])
+            if start <= end:
+                result.append((start, end))
+            if self.intervals[i][1] < other.intervals[j][1]:
+                i += 1
+            else:
+                j += 1
+        return self.__class__(result)
+
+    def __sub__(self, other):
+        return self & other.complement()
+
+    def complement(self):
+        """
+        Returns the set of all characters not in this set.
+        """
+        result = []
+        start = 0
+        for interval_start, interval_end in self.intervals:
+            if start < interval_start:
+                result.append((start, interval_start - 1))
+            start = interval_end + 1
+        if start <= sys.maxunicode:
+            result.append((start, sys.maxunicode))
+        return self.__class__(result)
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.intervals == other.intervals
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.intervals)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, list(self.intervals))
+
+
+def to_interval_set(characters):
+    """
+    Returns `characters` as an :class:`IntervalSet`, given either an
+    :class:`IntervalSet` or a set of characters.
+    """
+    if isinstance(characters, IntervalSet):
+        return characters
+    return IntervalSet.from_characters(characters)
+
+
+def get_boundaries(sets):
+    """
+    Returns the sorted code points at which membership in any of the given
+    interval `sets` may change: every interval of every set starts at one of
+    them and ends right before one of them.
+    """
+    boundaries = set()
+    for set_ in sets:
+        for start, end in set_.intervals:
+            boundaries.add(start)
+            boundaries.add(end + 1)
+    return sorted(boundaries)
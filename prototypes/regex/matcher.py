@@ -6,82 +6,237 @@
     :copyright: 2012 by Daniel Neuhäuser
     :license: BSD, see LICENSE.rst
 """
+from bisect import bisect_right
+from itertools import izip, imap
 from collections import namedtuple
 
 
 Span = namedtuple("Span", ["start", "end"])
 
 
+class LineIndex(object):
+    """
+    Converts positions in `string` into ``(line, column)`` pairs, both
+    starting at 0. The positions at which lines start are computed once, when
+    they are first needed, after that each position is resolved with a
+    binary search.
+    """
+    def __init__(self, string):
+        self.string = string
+
+    @property
+    def line_starts(self):
+        if not hasattr(self, "_line_starts"):
+            line_starts = [0]
+            position = self.string.find(u"\n")
+            while position != -1:
+                line_starts.append(position + 1)
+                position = self.string.find(u"\n", position + 1)
+            self._line_starts = line_starts
+        return self._line_starts
+
+    def get_position(self, position):
+        line = bisect_right(self.line_starts, position) - 1
+        return line, position - self.line_starts[line]
+
+
+def get_region(string, pos=0, endpos=None):
+    """
+    Returns `pos` and `endpos` limited to `string`, like :mod:`re` does: a
+    negative `pos` is treated as 0, a `pos` beyond the end of the string and
+    an `endpos` that is `None` or beyond the end as the length of the string.
+    """
+    if endpos is None or endpos > len(string):
+        endpos = len(string)
+    return min(max(pos, 0), len(string)), endpos
+
+
+def iter_region(string, pos=0, endpos=None):
+    """
+    Returns an iterator of ``(end, character)`` pairs for the characters in
+    ``string[pos:endpos]``, where `end` is the position following the
+    character in `string`. The region is not copied.
+    """
+    pos, endpos = get_region(string, pos, endpos)
+    if pos == 0 and endpos == len(string):
+        return enumerate(string, 1)
+    return izip(
+        xrange(pos + 1, endpos + 1),
+        imap(string.__getitem__, xrange(pos, endpos))
+    )
+
+
 class MatcherBase(object):
-    def match(self, string):
+    """
+    The methods of all matchers take the optional arguments `pos` and
+    `endpos`, which limit matching to the region ``string[pos:endpos]``
+    without copying it. Positions and spans are always relative to the
+    beginning of `string`.
+    """
+    def match(self, string, pos=0, endpos=None):
         """
         Returns `None` or the position of the last matching character +1 so
-        that ``string[:i]`` is the matched string.
+        that ``string[pos:i]`` is the matched string.
         """
         raise NotImplementedError()
 
-    def find(self, string, offset=0):
+    def find(self, string, pos=0, endpos=None):
         """
         Returns `None` or a :class:`Find` object.
         """
-        while len(string) >= offset:
-            end = self.match(string[offset:])
-            if end is not None:
-                return Find(string, Span(offset, offset + end))
-            offset += 1
-
-    def find_all(self, string, offset=0):
+        pos, endpos = get_region(string, pos, endpos)
+        while endpos >= pos:
+            find = self._find_at(string, pos, endpos)
+            if find is not None:
+                return find
+            pos += 1
+
+    def _find_at(self, string, pos, endpos):
+        end = self.match(string, pos, endpos)
+        if end is not None:
+            return Find(string, Span(pos, end))
+
+    def find_all(self, string, pos=0, endpos=None):
         """
-        Yields :class:`Find` objects.
+        Yields :class:`Find` objects, which share one :class:`LineIndex`.
         """
-        find = self.find(string, offset)
+        line_index = LineIndex(string)
+        find = self.find(string, pos, endpos)
         if find is not None:
+            find.line_index = line_index
             yield find
-            find = self.find(string, find.span.end)
+            find = self.find(string, find.span.end, endpos)
             while find is not None and len(find.match) != 0:
+                find.line_index = line_index
                 yield find
-                find = self.find(string, find.span.end)
+                find = self.find(string, find.span.end, endpos)
 
-    def subn(self, string, substitution):
-        if isinstance(substitution, unicode):
-            sub = lambda match: substitution
-        else:
-            sub = substitution
+    def subn(self, string, substitution, pos=0, endpos=None):
         result = []
-        n = previous_end = 0
-        for match in self.find_all(string):
-            result.append(string[previous_end:match.span.start])
-            result.append(sub(match))
-            previous_end = match.span.end
-            n += 1
-        result.append(string[previous_end:])
+        n = self._write_sub(result.append, string, substitution, pos, endpos)
         return u"".join(result), n
 
-    def sub(self, string, substitution):
-        return self.subn(string, substitution)[0]
+    def sub(self, string, substitution, pos=0, endpos=None):
+        return self.subn(string, substitution, pos, endpos)[0]
+
+    def subn_to(self, file, string, substitution, pos=0, endpos=None):
+        """
+        Writes the result of :meth:`sub` to the file-like object `file`,
+        piece by piece, and returns the number of substitutions made.
+        """
+        return self._write_sub(file.write, string, substitution, pos, endpos)
+
+    def iter_sub(self, string, substitution, pos=0, endpos=None):
+        """
+        Yields the result of :meth:`sub` in pieces, as they become known.
+        """
+        sub = get_substitution(substitution)
+        previous_end = 0
+        for match in self.find_all(string, pos, endpos):
+            yield string[previous_end:match.span.start]
+            yield sub(match)
+            previous_end = match.span.end
+        yield string[previous_end:]
+
+    def _write_sub(self, write, string, substitution, pos, endpos):
+        pieces = 0
+        for piece in self.iter_sub(string, substitution, pos, endpos):
+            write(piece)
+            pieces += 1
+        # every substitution is preceded by the string before it and the
+        # string after the last one comes at the end
+        return (pieces - 1) // 2
+
+
+def get_substitution(substitution):
+    """
+    Returns a function, that returns the replacement of a :class:`Find`,
+    given either a replacement string or such a function.
+    """
+    if isinstance(substitution, unicode):
+        return lambda match: substitution
+    return substitution
 
 
 class Find(object):
-    def __init__(self, string, span):
+    """
+    A match of a regex within `string`, at `span`. Matchers that report
+    groups, pass a tuple with a :class:`Span` or `None` for each group as
+    `groups`.
+    """
+    def __init__(self, string, span, groups=()):
         self.string = string
         self.span = span
+        self.groups = groups
+        self._line_index = None
 
     @property
     def match(self):
         return self.string[self.span.start:self.span.end]
 
+    @property
+    def line_index(self):
+        """
+        A :class:`LineIndex` for `string`, set by
+        :meth:`MatcherBase.find_all` or created when it is first needed.
+        """
+        if self._line_index is None:
+            self._line_index = LineIndex(self.string)
+        return self._line_index
+
+    @line_index.setter
+    def line_index(self, line_index):
+        self._line_index = line_index
+
+    @property
+    def position(self):
+        """
+        The line and column at which the match starts, both starting at 0.
+        """
+        return self.line_index.get_position(self.span.start)
+
+    @property
+    def line(self):
+        return self.position[0]
+
+    @property
+    def column(self):
+        return self.position[1]
+
+    def group(self, n=0):
+        """
+        Returns the string matched by the group `n`, the entire match for 0
+        or `None` if the group did not participate in the match.
+        """
+        if n == 0:
+            return self.match
+        span = self.groups[n - 1]
+        if span is not None:
+            return self.string[span.start:span.end]
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return self.string == other.string and self.span == other.span
+            return (
+                self.string == other.string and
+                self.span == other.span and
+                self.groups == other.groups
+            )
         return NotImplemented
 
     def __ne__(self, other):
         return not self == other
 
     def __hash__(self):
-        return hash(self.string) ^ hash(self.span)
+        return hash(self.string) ^ hash(self.span) ^ hash(self.groups)
 
     def __repr__(self):
+        if self.groups:
+            return "%s(%r, %r, %r)" % (
+                self.__class__.__name__,
+                self.string,
+                self.span,
+                self.groups
+            )
         return "%s(%r, %r)" % (
             self.__class__.__name__,
             self.string,
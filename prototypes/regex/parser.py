@@ -9,17 +9,27 @@
 import sys
 from itertools import imap
 from contextlib import contextmanager
-from collections import deque
 
 from regex.ast import (
-    Epsilon, Any, Character, Concatenation, Union, Repetition, Group, Either,
-    Neither, Range
+    Epsilon, Any, Character, Concatenation, Union, Repetition,
+    ContinuedRepetition, CountedRepetition, Group, Either, Neither, Range,
+    CharacterClass, UnicodeAlphabet, is_complete
+)
+from regex.intervals import IntervalSet
+from regex.unicode import (
+    get_property, get_shorthand, get_case_variants, fold_case
 )
 
 
-DEFAULT_ALPHABET = frozenset(
-    Character(unichr(i)) for i in xrange(sys.maxunicode)
-)
+DEFAULT_ALPHABET = UnicodeAlphabet()
+
+#: Maps the characters, that follow an escape to form a shorthand class, to
+#: the name of the class and whether it is negated.
+DEFAULT_SHORTHANDS = {
+    u"d": (u"digit", False), u"D": (u"digit", True),
+    u"w": (u"word", False), u"W": (u"word", True),
+    u"s": (u"space", False), u"S": (u"space", True)
+}
 
 
 class RegexException(Exception):
@@ -48,7 +58,11 @@ class Language(object):
                  neither_indicator=u"^",
                  zero_or_more=u"*", one_or_more=u"+",
                  range=u"-",
-                 any=u"."
+                 any=u".",
+                 repetition_begin=u"{", repetition_end=u"}",
+                 repetition_separator=u",",
+                 shorthands=DEFAULT_SHORTHANDS,
+                 property=u"p", negated_property=u"P"
                  ):
         self.escape = escape
         self.union = union
@@ -61,6 +75,12 @@ class Language(object):
         self.neither_indicator = neither_indicator
         self.range = range
         self.any = any
+        self.repetition_begin = repetition_begin
+        self.repetition_end = repetition_end
+        self.repetition_separator = repetition_separator
+        self.shorthands = shorthands
+        self.property = property
+        self.negated_property = negated_property
 
     def __eq__(self, other):
         if self is other:
@@ -77,7 +97,13 @@ class Language(object):
                 self.one_or_more == other.one_or_more and
                 self.neither_indicator == other.neither_indicator and
                 self.range == other.range and
-                self.any == other.any
+                self.any == other.any and
+                self.repetition_begin == other.repetition_begin and
+                self.repetition_end == other.repetition_end and
+                self.repetition_separator == other.repetition_separator and
+                self.shorthands == other.shorthands and
+                self.property == other.property and
+                self.negated_property == other.negated_property
             )
         return NotImplemented
 
@@ -93,7 +119,8 @@ class Language(object):
             self.either_begin, self.either_end,
             self.zero_or_more, self.one_or_more,
             self.range,
-            self.any
+            self.any,
+            self.repetition_begin, self.repetition_end
         ])
 
     @property
@@ -112,6 +139,10 @@ class Language(object):
     def either_characters(self):
         return [self.either_begin, self.either_end]
 
+    @property
+    def counted_repetition_characters(self):
+        return [self.repetition_begin, self.repetition_end]
+
     def escape_character(self, character):
         if character in self.special_characters:
             return self.escape + character
@@ -128,18 +159,29 @@ class Language(object):
         elif isinstance(regex, Character):
             return self.escape(regex.raw)
         elif isinstance(regex, Concatenation):
-            return self.to_unicode(regex.left) + self.to_unicode(regex.right)
+            return u"".join(imap(self.to_unicode, regex.operands))
         elif isinstance(regex, Union):
-            return u"%s%s%s" % (
-                self.to_unicode(regex.left),
-                self.union,
-                self.to_unicode(regex.right)
-            )
+            return self.union.join(imap(self.to_unicode, regex.operands))
         elif isinstance(regex, Repetition):
             return u"%s%s" % (
                 self.to_unicode(regex.repeated),
                 self.zero_or_more
             )
+        elif isinstance(regex, CountedRepetition):
+            if regex.minimum == regex.maximum:
+                bounds = u"%d" % regex.minimum
+            else:
+                bounds = u"%d%s%s" % (
+                    regex.minimum,
+                    self.repetition_separator,
+                    u"" if regex.maximum is None else regex.maximum
+                )
+            return u"%s%s%s%s" % (
+                self.to_unicode(regex.repeated),
+                self.repetition_begin,
+                bounds,
+                self.repetition_end
+            )
         elif isinstance(regex, Group):
             return u"%s%s%s" % (
                 self.group_begin,
@@ -165,6 +207,22 @@ class Language(object):
                 self.range,
                 self.to_unicode(regex.end)
             )
+        elif isinstance(regex, CharacterClass):
+            intervals = []
+            for start, end in regex.characters.intervals:
+                if start == end:
+                    intervals.append(self.escape_character(unichr(start)))
+                else:
+                    intervals.append(u"%s%s%s" % (
+                        self.escape_character(unichr(start)),
+                        self.range,
+                        self.escape_character(unichr(end))
+                    ))
+            if intervals and intervals[0].startswith(self.neither_indicator):
+                intervals[0] = self.escape + intervals[0]
+            return u"%s%s%s" % (
+                self.either_begin, u"".join(intervals), self.either_end
+            )
         raise NotImplementedError(regex)
 
 
@@ -174,8 +232,6 @@ DEFAULT_LANGUAGE = Language()
 class Input(object):
     def __init__(self, string):
         self.string = string
-        self.characters = iter(self.string)
-        self.remaining = deque()
         self.position = -1
 
     def __iter__(self):
@@ -183,44 +239,43 @@ class Input(object):
 
     @property
     def is_consumed(self):
-        try:
-            self.lookahead()
-            return False
-        except StopIteration:
-            return True
+        return self.position + 1 >= len(self.string)
 
     def next(self, fail_unexpected=False, reason=u"unexpected end of string"):
-        try:
-            if self.remaining:
-                result = self.remaining.popleft()
-            else:
-                result = next(self.characters)
-            self.position += 1
-            return result
-        except StopIteration:
+        position = self.position + 1
+        if position >= len(self.string):
             if fail_unexpected:
-                raise Parser(
-                    reason,
-                    self.annotated(self.position + 1)
-                )
-            raise
+                raise ParserError(reason, self.annotated(position))
+            raise StopIteration()
+        self.position = position
+        return self.string[position]
 
     def lookahead(self, n=1, inclusive=False):
-        while len(self.remaining) < n:
-            self.remaining.append(next(self.characters))
+        position = self.position + n
+        if position >= len(self.string):
+            raise StopIteration()
         if inclusive:
-            return self.remaining[:n - 1]
-        return self.remaining[n - 1]
+            return self.string[self.position + 1:position + 1]
+        return self.string[position]
+
+    def peek(self):
+        """
+        Returns the next character without consuming it or `None`, if the
+        input is consumed.
+        """
+        try:
+            return self.lookahead()
+        except StopIteration:
+            return None
 
     def consume(self, n=1):
-        if len(self.remaining) > n:
+        if self.position + n >= len(self.string):
             raise RuntimeError(
-                "attempting to consume %d, looked ahead only %d" % (
-                    n, len(self.remaining)
+                "attempting to consume %d, only %d remaining" % (
+                    n, len(self.string) - self.position - 1
                 )
             )
-        for _ in range(n):
-            self.next()
+        self.position += n
 
     def annotated(self, position=None):
         position = self.position if position is None else position
@@ -239,19 +294,25 @@ class Input(object):
 
 
 class Parser(object):
-    def __init__(self, language, alphabet=DEFAULT_ALPHABET):
+    """
+    Parses regexes written in `language` over `alphabet`. If `ignore_case`
+    is true, characters match all characters equal to them ignoring case,
+    which is resolved here, so that matching requires no extra work.
+    """
+    def __init__(self, language, alphabet=DEFAULT_ALPHABET, ignore_case=False):
         self.language = language
         self.alphabet = alphabet
+        self.ignore_case = ignore_case
 
     def expect(self, input, expected):
         assert len(expected) == 1
         actual = input.next(
             fail_unexpected=True,
-            reason=u"unexpected end of string, expected %s" % input
+            reason=u"unexpected end of string, expected %s" % expected
         )
         if actual != expected:
             raise ParserError(
-                "expected %s, got %s" % (actual, expected),
+                "expected %s, got %s" % (expected, actual),
                 input.annotated()
             )
 
@@ -289,10 +350,10 @@ class Parser(object):
                         input.annotated_range(start_position)
                     )
 
-    def finish(self, result):
-        if result is None:
+    def finish(self, concatenated):
+        if not concatenated:
             return Epsilon()
-        return result
+        return Concatenation(*concatenated)
 
     def parse(self, string):
         input = Input(string)
@@ -312,92 +373,223 @@ class Parser(object):
         return result
 
     def parse_expression(self, input):
-        result = None
+        escape = self.language.escape
+        repetition_characters = self.language.repetition_characters
+        one_or_more = self.language.one_or_more
+        repetition_begin = self.language.repetition_begin
+        union = self.language.union
+        group_begin = self.language.group_begin
+        either_begin = self.language.either_begin
+        any_character = self.language.any
+        end_characters = self.language.end_characters
+
+        alternatives = []
+        concatenated = []
         while True:
             try:
                 character = input.lookahead()
             except StopIteration:
                 break
 
-            if character == self.language.escape:
+            if character == escape:
                 input.consume()
-                result = self.concat_or_return(
-                    result,
-                    Character(
-                        self.language,
-                        self.input.next(
-                            fail_unexpected=True,
-                            reason=u"unexpected end of string, "
-                                   u"following escape character"
-                        )
-                    )
+                character = input.next(
+                    fail_unexpected=True,
+                    reason=u"unexpected end of string, "
+                           u"following escape character"
                 )
-            elif character in self.language.repetition_characters:
+                characters = self.parse_class(input, character)
+                if characters is None:
+                    concatenated.append(self.make_character(character))
+                else:
+                    concatenated.append(self.make_class(characters))
+            elif character in repetition_characters:
                 input.consume()
-                if result is None:
+                if not concatenated:
                     raise ParserError(
-                        u"%s is not preceded by a repeatable expression" % character,
+                        u"%s is not preceded by a repeatable expression" %
+                        character,
                         input.annotated()
                     )
-                require_once = character == self.language.one_or_more
-                if require_once:
-                    result = Concatenation(result, result)
-                if isinstance(result, Concatenation):
-                    result = Concatenation(
-                        result.left,
-                        Repetition(result.right)
-                    )
+                if character == one_or_more:
+                    # the entire expression since the last union or the
+                    # beginning of the group is repeated
+                    repeated = Concatenation(*concatenated)
+                    concatenated = [repeated, ContinuedRepetition(repeated)]
                 else:
-                    result = Repetition(result)
-            elif character == self.language.union:
-                input.consume()
-                result = Union(
-                    self.finish(result),
-                    self.parse_expression(input)
-                )
-            elif character == self.language.group_begin:
-                result = self.concat_or_return(result, self.parse_group(input))
-            elif character == self.language.either_begin:
-                result = self.concat_or_return(
-                    result, self.parse_either_or_neither(input)
+                    concatenated[-1] = Repetition(concatenated[-1])
+            elif (character == repetition_begin and
+                  self.is_counted_repetition(input)):
+                if not concatenated:
+                    raise ParserError(
+                        u"%s is not preceded by a repeatable expression" %
+                        character,
+                        input.annotated(input.position + 1)
+                    )
+                minimum, maximum = self.parse_counted_repetition(input)
+                concatenated[-1] = CountedRepetition(
+                    concatenated[-1], minimum, maximum
                 )
-            elif character == self.language.any:
+            elif character == union:
+                input.consume()
+                alternatives.append(self.finish(concatenated))
+                concatenated = []
+            elif character == group_begin:
+                concatenated.append(self.parse_group(input))
+            elif character == either_begin:
+                concatenated.append(self.parse_either_or_neither(input))
+            elif character == any_character:
                 input.consume()
-                result = self.concat_or_return(result, Any(self.alphabet))
-            elif character in self.language.end_characters:
+                concatenated.append(Any(self.alphabet))
+            elif character in end_characters:
                 break
             else:
                 input.consume()
-                result = self.concat_or_return(
-                    result,
-                    Character(character)
-                )
-        return self.finish(result)
-
-    def concat_or_return(self, result, regex):
-        if result is None:
-            return regex
-        return Concatenation(result, regex)
+                concatenated.append(self.make_character(character))
+        alternatives.append(self.finish(concatenated))
+        return Union(*alternatives)
 
     def parse_group(self, input):
         with self.expect_surrounding(input, *self.language.group_characters):
             return Group(self.parse_expression(input))
 
-    def parse_either_or_neither(self, input):
-        with self.expect_surrounding(input, *self.language.either_characters):
-            if input.lookahead() == self.language.neither_indicator:
-                input.consume()
-                return Neither(
-                    self.parse_either_or_neither_body(
-                        input, self.language.either_end
+    def is_counted_repetition(self, input):
+        """
+        Returns `True`, if the input continues with a well-formed counted
+        repetition. Like :mod:`re` any other repetition begin or end is taken
+        literally.
+        """
+        string = input.string
+        position = input.position + 2
+        digits_start = position
+        while position < len(string) and string[position].isdigit():
+            position += 1
+        if position == digits_start:
+            return False
+        if string[position:position + 1] == self.language.repetition_separator:
+            position += 1
+            while position < len(string) and string[position].isdigit():
+                position += 1
+        return string[position:position + 1] == self.language.repetition_end
+
+    def parse_counted_repetition(self, input):
+        characters = self.language.counted_repetition_characters
+        with self.expect_surrounding(input, *characters):
+            start_position = input.position
+            minimum = self.parse_number(input)
+            if input.peek() != self.language.repetition_separator:
+                return minimum, minimum
+            input.consume()
+            if input.peek() in (self.language.repetition_end, None):
+                return minimum, None
+            maximum = self.parse_number(input)
+            if maximum < minimum:
+                raise ParserError(
+                    u"maximum %d is smaller than minimum %d" % (
+                        maximum, minimum
                     ),
-                    self.alphabet
+                    input.annotated_range(start_position, input.position + 1)
                 )
-            return Either(
-                self.parse_either_or_neither_body(
-                    input, self.language.either_end
+            return minimum, maximum
+
+    def parse_number(self, input):
+        digits = []
+        while input.peek() is not None and input.peek().isdigit():
+            digits.append(input.next())
+        if not digits:
+            raise ParserError(
+                u"expected number",
+                input.annotated(input.position + 1)
+            )
+        return int(u"".join(digits))
+
+    def parse_class(self, input, character):
+        """
+        Parses the shorthand class or property following an escape, given
+        the `character` following the escape. Returns the characters in the
+        class as an :class:`IntervalSet` or `None`, if the character does not
+        introduce a class.
+        """
+        if character in self.language.shorthands:
+            name, negated = self.language.shorthands[character]
+            characters = get_shorthand(name)
+        elif character in (
+            self.language.property, self.language.negated_property
+        ):
+            negated = character == self.language.negated_property
+            characters = self.parse_property(input)
+        else:
+            return None
+        if self.ignore_case:
+            characters = fold_case(characters)
+        if negated:
+            return characters.complement()
+        return characters
+
+    def parse_property(self, input):
+        characters = self.language.counted_repetition_characters
+        with self.expect_surrounding(input, *characters):
+            start_position = input.position
+            name = []
+            while input.peek() not in (self.language.repetition_end, None):
+                name.append(input.next())
+            name = u"".join(name)
+            try:
+                return get_property(name)
+            except KeyError:
+                raise ParserError(
+                    u"unknown property %s" % name,
+                    input.annotated_range(start_position, input.position + 1)
                 )
+
+    def make_character(self, character):
+        if not self.ignore_case:
+            return Character(character)
+        variants = frozenset(
+            Character(variant) for variant in get_case_variants(character)
+        )
+        if len(variants) == 1:
+            return Character(character)
+        return Either(variants & self.alphabet | {Character(character)})
+
+    def make_class(self, characters):
+        if not is_complete(self.alphabet):
+            characters &= IntervalSet.from_characters(
+                character.raw for character in self.alphabet
             )
+        return CharacterClass(characters)
+
+    def parse_either_or_neither(self, input):
+        with self.expect_surrounding(input, *self.language.either_characters):
+            negated = input.lookahead() == self.language.neither_indicator
+            if negated:
+                input.consume()
+            body = self.parse_either_or_neither_body(
+                input, self.language.either_end
+            )
+            if self.ignore_case or any(
+                isinstance(item, CharacterClass) for item in body
+            ):
+                # classes are combined as intervals, without enumerating
+                # their characters
+                characters = IntervalSet([])
+                for item in body:
+                    if isinstance(item, CharacterClass):
+                        characters |= item.characters
+                    elif isinstance(item, Range):
+                        characters |= IntervalSet.from_range(
+                            item.start.raw, item.end.raw
+                        )
+                    else:
+                        characters |= IntervalSet.from_characters(item.raw)
+                if self.ignore_case:
+                    characters = fold_case(characters)
+                if negated:
+                    characters = characters.complement()
+                return self.make_class(characters)
+            if negated:
+                return Neither(body, self.alphabet)
+            return Either(body)
 
     def parse_either_or_neither_body(self, input, until):
         result = []
@@ -411,8 +603,13 @@ class Parser(object):
             input.consume()
             if character == self.language.escape:
                 character = input.next()
+                characters = self.parse_class(input, character)
+                if characters is None:
+                    result.append(Character(character))
+                else:
+                    result.append(CharacterClass(characters))
             elif character == self.language.range:
-                if not result:
+                if not result or isinstance(result[-1], CharacterClass):
                     raise ParserError(
                         u"range is missing start",
                         input.annotated(input.position - 1)
@@ -431,7 +628,13 @@ class Parser(object):
     def parse_character(self, input):
         character = input.next(fail_unexpected=True)
         if character == self.language.escape:
+            escape_position = input.position
             character = input.next(fail_unexpected=True)
+            if self.parse_class(input, character) is not None:
+                raise ParserError(
+                    u"range is missing end",
+                    input.annotated_range(escape_position, input.position)
+                )
         elif character in self.language.special_characters:
             raise ParserError(
                 "expected character, found instruction: %s" % character,
@@ -440,5 +643,6 @@ class Parser(object):
         return Character(character)
 
 
-def parse(string):
-    return Parser(DEFAULT_LANGUAGE, DEFAULT_ALPHABET).parse(string)
+def parse(string, ignore_case=False):
+    parser = Parser(DEFAULT_LANGUAGE, DEFAULT_ALPHABET, ignore_case)
+    return parser.parse(string)
@@ -0,0 +1,133 @@
+# coding: utf-8
+"""
+    regex.regexset
+    ~~~~~~~~~~~~~~
+
+    Matches many regexes at once, in a single pass over the string.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+from regex.parser import parse
+from regex.fa import NFA, NFAState
+
+
+class LazyDFA(object):
+    """
+    A DFA whose states are epsilon closures of `nfa`, constructed when they
+    are first reached, so only the part of the - potentially huge - DFA that
+    is actually used is ever built.
+
+    Every state has the set of ids of the regexes it accepts, given by
+    `final_masks`, a list of ``(mask, id)`` pairs.
+
+    `restart` is added to the closure after every transition; passing the
+    closure of the start state lets matches begin at any position.
+    """
+    def __init__(self, nfa, final_masks, restart=0):
+        self.nfa = nfa
+        self.final_masks = final_masks
+        self.restart = restart
+        self.ids = {}
+        self.closures = []
+        self.transitions = []
+        self.accepting = []
+        self.start = self.get_state(nfa.get_start_closure())
+
+    def get_state(self, closure):
+        state = self.ids.get(closure)
+        if state is None:
+            state = self.ids[closure] = len(self.closures)
+            self.closures.append(closure)
+            self.transitions.append({})
+            self.accepting.append(frozenset(
+                id for mask, id in self.final_masks if closure & mask
+            ))
+        return state
+
+    def transition(self, state, character):
+        transitions = self.transitions[state]
+        target = transitions.get(character)
+        if target is None:
+            target = transitions[character] = self.get_state(
+                self.nfa.move_closure(self.closures[state], character) |
+                self.restart
+            )
+        return target
+
+    def is_dead(self, state):
+        return not self.closures[state]
+
+
+class RegexSet(object):
+    """
+    Matches all `regexes` simultaneously. The regexes are combined into a
+    single NFA, which is lazily converted into a DFA whose accepting states
+    carry the ids - the indices in `regexes` - of the regexes they accept.
+
+    :param regexes: A list of regex strings or :class:`regex.ast.Regex`
+                    objects.
+    """
+    def __init__(self, regexes):
+        self.regexes = [
+            parse(regex) if isinstance(regex, basestring) else regex
+            for regex in regexes
+        ]
+        # counted repetitions are expanded, as the closures of the lazy DFA
+        # cannot represent counters
+        nfas = [
+            regex.optimize().expand().to_nfa() for regex in self.regexes
+        ]
+        nfa = NFA(NFAState(epsilon_moves=[nfa.start for nfa in nfas]), None)
+        final_masks = [
+            (nfa.get_state_mask(regex_nfa.final), id)
+            for id, regex_nfa in enumerate(nfas)
+        ]
+        self._anchored = LazyDFA(nfa, final_masks)
+        self._unanchored = LazyDFA(nfa, final_masks, nfa.get_start_closure())
+
+    def match(self, string):
+        """
+        Returns a dictionary mapping the id of every regex matching at the
+        beginning of `string` to the end of its match, as returned by
+        :meth:`regex.matcher.MatcherBase.match`.
+        """
+        dfa = self._anchored
+        state = dfa.start
+        ends = {}
+        for i, character in enumerate(string, 1):
+            state = dfa.transition(state, character)
+            if dfa.is_dead(state):
+                break
+            for id in dfa.accepting[state]:
+                ends[id] = i
+        else:
+            for id in dfa.accepting[state]:
+                ends.setdefault(id, 0)
+        return ends
+
+    def scan(self, string):
+        """
+        Yields ``(end, ids)`` for every position `end` in `string` at which
+        a match of at least one regex ends, `ids` is a frozenset of the ids
+        of these regexes.
+        """
+        dfa = self._unanchored
+        state = dfa.start
+        if dfa.accepting[state]:
+            yield 0, dfa.accepting[state]
+        for i, character in enumerate(string, 1):
+            state = dfa.transition(state, character)
+            if dfa.accepting[state]:
+                yield i, dfa.accepting[state]
+
+    def matching(self, string):
+        """
+        Returns the set of ids of the regexes matching anywhere in `string`.
+        """
+        result = set()
+        for _, ids in self.scan(string):
+            result.update(ids)
+            if len(result) == len(self.regexes):
+                break
+        return result
@@ -0,0 +1,142 @@
+# coding: utf-8
+"""
+    regex.search
+    ~~~~~~~~~~~~
+
+    Searches files for lines matching a regex, distributing the files across
+    a pool of processes.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+import os
+import sys
+import codecs
+from multiprocessing import Pool
+
+from regex.parser import parse
+from regex.ast import Concatenation, Repetition, CharacterClass
+from regex.intervals import IntervalSet
+
+
+#: The DFA used by the worker processes, set by :func:`_initialize`.
+_dfa = None
+
+
+def _initialize(dfa):
+    global _dfa
+    _dfa = dfa
+
+
+def to_line_dfa(regex):
+    """
+    Returns a DFA for `regex` preceded by a repetition of any character,
+    which reaches a final state as soon as it has read the end of a match,
+    so that :func:`contains_match` tests a line in a single pass.
+    """
+    return Concatenation(
+        Repetition(CharacterClass(IntervalSet([(0, sys.maxunicode)]))),
+        regex.optimize()
+    ).to_searchable_dfa()
+
+
+def contains_match(dfa, line):
+    """
+    Returns `True`, if `line` contains a match of the regex `dfa` has been
+    created for by :func:`to_line_dfa`.
+    """
+    transition = dfa.transition
+    finals = dfa.finals
+    state = 0
+    if state in finals:
+        return True
+    for character in line:
+        state = transition(state, character)
+        if state is None:
+            return False
+        if state in finals:
+            return True
+    return False
+
+
+def iter_paths(paths):
+    """
+    Yields the paths of all files in `paths`, walking directories
+    recursively in sorted order.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, directories, files in os.walk(path):
+                directories.sort()
+                for name in sorted(files):
+                    yield os.path.join(directory, name)
+        else:
+            yield path
+
+
+def read_text(path, encoding="utf-8"):
+    """
+    Returns the contents of the file at `path` decoded with `encoding`. The
+    file is read in a single block and undecodable bytes are replaced.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    return codecs.decode(data, encoding, "replace")
+
+
+def search_file(dfa, path, encoding="utf-8"):
+    """
+    Returns a list of ``(line_number, line)`` pairs for every line in the
+    file at `path` that contains a match of the regex `dfa` has been created
+    for by :func:`to_line_dfa`. Line numbers start at 1.
+    """
+    text = read_text(path, encoding)
+    return [
+        (line_number, line)
+        for line_number, line in enumerate(text.splitlines(), 1)
+        if contains_match(dfa, line)
+    ]
+
+
+def _search_file(path):
+    try:
+        return path, search_file(_dfa, path), None
+    except IOError as error:
+        return path, [], error
+
+
+def search(regex, paths, jobs=None, ordered=True, ignore_case=False,
+           on_error=None):
+    """
+    Yields ``(path, line_number, line)`` for every line matching `regex` in
+    the files in `paths`.
+
+    The regex is compiled once, by :func:`to_line_dfa`, and the DFA is passed
+    to each of the `jobs` worker processes - as many as there are CPUs if
+    `None` - when it is started. Results are yielded as soon as a file has
+    been searched, in the order of the files if `ordered` is true and
+    otherwise in the order the workers finish them.
+
+    Files that cannot be read are skipped, if `on_error` is given it is
+    called with the path and the :exc:`IOError` for each of them, otherwise
+    the error is raised.
+
+    :param regex: A regex string or :class:`regex.ast.Regex` object.
+    :param ignore_case: Whether a regex string matches ignoring case.
+    """
+    if isinstance(regex, basestring):
+        regex = parse(regex, ignore_case)
+    pool = Pool(jobs, _initialize, (to_line_dfa(regex), ))
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for path, lines, error in imap(_search_file, iter_paths(paths), 16):
+            if error is not None:
+                if on_error is None:
+                    raise error
+                on_error(path, error)
+            for line_number, line in lines:
+                yield path, line_number, line
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,200 @@
+# coding: utf-8
+"""
+    regex.stream
+    ~~~~~~~~~~~~
+
+    Searches streams of text, which are available in chunks only, without
+    buffering the entire stream.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+from itertools import chain
+
+from regex.parser import parse
+from regex.matcher import Find, Span, get_substitution
+
+
+class StreamError(Exception):
+    def __init__(self, reason, position):
+        Exception.__init__(self, reason, position)
+        self.reason = reason
+        self.position = position
+
+
+class StreamFind(Find):
+    """
+    A :class:`Find` in a stream, `string` is only the matched part of the
+    stream while `span` is relative to the beginning of the stream.
+    """
+    @property
+    def match(self):
+        return self.string
+
+    @property
+    def line_index(self):
+        raise AttributeError("the positions of finds in streams are unknown")
+
+
+class StreamSearcher(object):
+    """
+    Searches a stream of text, that is fed to it in chunks, for the same
+    matches :meth:`regex.matcher.MatcherBase.find_all` finds in the entire
+    stream.
+
+    The state of the DFA is kept between chunks and finds are returned as
+    soon as they are known. Only the characters since the beginning of the
+    current match attempt are kept, if an attempt spans more than
+    `max_lookback` characters a :exc:`StreamError` is raised. Counted
+    repetitions, which are too large for a DFA table, are matched with a
+    :class:`regex.fa.DerivativeDFA`.
+
+    :param regex: A regex string or :class:`regex.ast.Regex` object.
+    """
+    def __init__(self, regex, max_lookback=2 ** 16):
+        if isinstance(regex, basestring):
+            regex = parse(regex)
+        regex = regex.optimize()
+        self.dfa = regex.to_searchable_dfa()
+        self.max_lookback = max_lookback
+        self._buffer = u""
+        # position of the first character in the buffer
+        self._buffer_start = 0
+        # position at which the current match attempt started
+        self._start = 0
+        # number of characters consumed by the current attempt
+        self._consumed = 0
+        self._state = 0
+        self._last_end = None
+        self._found = False
+        self._done = False
+
+    @property
+    def position(self):
+        """
+        The position at which the current match attempt started, no find
+        returned later starts before this position.
+        """
+        return self._start
+
+    def feed(self, chunk):
+        """
+        Feeds the next `chunk` of the stream to the searcher and returns a
+        list of the :class:`StreamFind`\\s that became known.
+        """
+        self._buffer = self._buffer[self._start - self._buffer_start:] + chunk
+        self._buffer_start = self._start
+        finds = []
+        self._run(finds)
+        if self._consumed > self.max_lookback:
+            raise StreamError(
+                "match attempt at position %d exceeds the lookback of %d "
+                "characters" % (self._start, self.max_lookback),
+                self._start
+            )
+        return finds
+
+    def close(self):
+        """
+        Signals the end of the stream and returns a list of the remaining
+        :class:`StreamFind`\\s.
+        """
+        finds = []
+        while not self._done:
+            self._run(finds)
+            if self._done:
+                break
+            # the attempt reached the end of the stream
+            if self._last_end is not None:
+                self._emit(finds, self._last_end)
+            elif self._consumed == 0:
+                if 0 in self.dfa.finals:
+                    self._emit(finds, self._start)
+                else:
+                    self._done = True
+            else:
+                self._begin(self._start + 1)
+        return finds
+
+    def _run(self, finds):
+        transition = self.dfa.transition
+        finals = self.dfa.finals
+        buffer = self._buffer
+        while not self._done:
+            index = self._start - self._buffer_start + self._consumed
+            if index >= len(buffer):
+                break
+            state = transition(self._state, buffer[index])
+            if state is None:
+                if self._last_end is None:
+                    self._begin(self._start + 1)
+                else:
+                    self._emit(finds, self._last_end)
+                continue
+            self._state = state
+            self._consumed += 1
+            if self._state in finals:
+                self._last_end = self._start + self._consumed
+
+    def _begin(self, start):
+        self._start = start
+        self._consumed = 0
+        self._state = 0
+        self._last_end = None
+
+    def _emit(self, finds, end):
+        if self._found and end == self._start:
+            # find_all stops at the first empty match, after the first match
+            self._done = True
+            return
+        index = self._start - self._buffer_start
+        finds.append(StreamFind(
+            self._buffer[index:index + end - self._start],
+            Span(self._start, end)
+        ))
+        self._found = True
+        self._begin(end)
+
+
+def iter_finds(regex, chunks, max_lookback=2 ** 16):
+    """
+    Yields the :class:`StreamFind`\\s of `regex` in the stream given by the
+    iterable `chunks`.
+    """
+    searcher = StreamSearcher(regex, max_lookback)
+    for chunk in chunks:
+        for find in searcher.feed(chunk):
+            yield find
+    for find in searcher.close():
+        yield find
+
+
+def iter_sub(regex, chunks, substitution, max_lookback=2 ** 16):
+    """
+    Yields the result of substituting the matches of `regex` in the stream
+    given by the iterable `chunks`, in pieces as soon as they are known.
+
+    Apart from the characters kept by the :class:`StreamSearcher`, only the
+    characters that may still become part of a match are kept.
+    """
+    sub = get_substitution(substitution)
+    searcher = StreamSearcher(regex, max_lookback)
+    # the characters from position `written` on, that have not been yielded
+    pending = u""
+    written = 0
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            finds = searcher.close()
+        else:
+            pending += chunk
+            finds = searcher.feed(chunk)
+        for find in finds:
+            yield pending[:find.span.start - written]
+            yield sub(find)
+            pending = pending[find.span.end - written:]
+            written = find.span.end
+        if searcher.position > written:
+            yield pending[:searcher.position - written]
+            pending = pending[searcher.position - written:]
+            written = searcher.position
+    yield pending
@@ -6,19 +6,41 @@
     :copyright: 2012 by Daniel Neuhäuser
     :license: BSD, see LICENSE.rst
 """
+import os
+import shutil
+import pickle
+import tempfile
+from threading import Event
+from multiprocessing.pool import ThreadPool
 from unittest import TestCase
 from itertools import izip
 from contextlib import contextmanager
+from io import StringIO
 
 from regex.parser import (
     parse, ParserError, Parser, DEFAULT_ALPHABET, DEFAULT_LANGUAGE
 )
 from regex.ast import (
     Epsilon, Character, Concatenation, Union, Repetition, Group, Either,
-    Neither, Range, Any
+    Neither, Range, Any, Empty, CountedRepetition, ContinuedRepetition,
+    CharacterClass, concatenate, union, repeat
 )
-from regex.matcher import Find, Span
+from regex.intervals import IntervalSet
+from regex.unicode import get_property, get_shorthand
+from regex.fa import NFA, DFATable, BitParallelNFA
+from regex.matcher import Find, Span, LineIndex
 from regex.tokenizer import Tokenizer, Token, TokenizerError
+from regex.words import compile_words
+from regex.regexset import RegexSet
+from regex.search import search
+from regex.trigram import (
+    TrigramIndex, All, Trigram, And, Or, get_query, write_index
+)
+from regex.backward import BackwardSearcher
+from regex.background import BackgroundMatcher
+from regex.stream import (
+    StreamSearcher, StreamError, StreamFind, iter_finds, iter_sub
+)
 
 
 class TestParser(TestCase):
@@ -40,6 +62,19 @@ class TestParser(TestCase):
             Union(Character(u"a"), Character(u"b"))
         )
 
+    def test_large_union(self):
+        # would exceed the recursion limit, if unions were parsed recursively
+        words = [u"keyword%d" % i for i in xrange(10000)]
+        regex = parse(u"|".join(words))
+        self.assertIsInstance(regex, Union)
+        self.assertEqual(len(regex.operands), len(words))
+
+    def test_escape(self):
+        self.assertEqual(
+            parse(u"\\*a"),
+            Concatenation(Character(u"*"), Character(u"a"))
+        )
+
     def test_zero_or_more(self):
         self.assertEqual(
             parse(u"a*"),
@@ -62,7 +97,9 @@ class TestParser(TestCase):
     def test_one_or_more(self):
         self.assertEqual(
             parse(u"a+"),
-            Concatenation(Character(u"a"), Repetition(Character(u"a")))
+            Concatenation(
+                Character(u"a"), ContinuedRepetition(Character(u"a"))
+            )
         )
 
     def test_one_or_more_missing_repeatable(self):
@@ -81,6 +118,54 @@ class TestParser(TestCase):
             )
         )
 
+    def test_counted_repetition(self):
+        a = Character(u"a")
+        self.assertEqual(parse(u"a{2,3}"), CountedRepetition(a, 2, 3))
+        self.assertEqual(parse(u"a{2}"), CountedRepetition(a, 2, 2))
+        self.assertEqual(parse(u"a{2,}"), CountedRepetition(a, 2, None))
+
+    def test_counted_repetition_missing_repeatable(self):
+        with self.assertRaises(ParserError) as context:
+            parse(u"{2}")
+        exception = context.exception
+        self.assertEqual(
+            exception.reason,
+            u"{ is not preceded by a repeatable expression"
+        )
+        self.assertEqual(exception.annotation, (
+            u"{2}\n"
+            u"^"
+        ))
+
+    def test_literal_repetition_characters(self):
+        self.assertEqual(parse(u"{"), Character(u"{"))
+        self.assertEqual(parse(u"}"), Character(u"}"))
+        self.assertEqual(
+            parse(u"a{b}"),
+            Concatenation(*map(Character, u"a{b}"))
+        )
+        self.assertEqual(
+            parse(u"a{2"),
+            Concatenation(*map(Character, u"a{2"))
+        )
+        self.assertEqual(
+            parse(u"a{,2}"),
+            Concatenation(*map(Character, u"a{,2}"))
+        )
+
+    def test_counted_repetition_invalid_bounds(self):
+        with self.assertRaises(ParserError) as context:
+            parse(u"a{3,2}")
+        exception = context.exception
+        self.assertEqual(
+            exception.reason,
+            u"maximum 2 is smaller than minimum 3"
+        )
+        self.assertEqual(exception.annotation, (
+            u"a{3,2}\n"
+            u" ^---^"
+        ))
+
     def test_group(self):
         self.assertEqual(
             parse(u"(a)"),
@@ -202,6 +287,19 @@ class TestParser(TestCase):
             )
         )
 
+    def test_range_class_end(self):
+        with self.assertRaises(ParserError) as context:
+            parse(u"[a-\\w]")
+        exception = context.exception
+        self.assertEqual(exception.reason, u"range is missing end")
+        self.assertEqual(
+            exception.annotation,
+            (
+                u"[a-\\w]\n"
+                u"   ^^"
+            )
+        )
+
     def test_any(self):
         parser = Parser(DEFAULT_LANGUAGE, alphabet=frozenset(u"ab"))
         self.assertEqual(
@@ -209,11 +307,63 @@ class TestParser(TestCase):
             Any(frozenset(u"ab"))
         )
 
+    def test_shorthand(self):
+        self.assertEqual(
+            parse(u"\\d"),
+            CharacterClass(get_shorthand(u"digit"))
+        )
+        self.assertEqual(
+            parse(u"\\W"),
+            CharacterClass(get_shorthand(u"word").complement())
+        )
+        self.assertEqual(
+            parse(u"[\\d_]"),
+            CharacterClass(
+                get_shorthand(u"digit") | IntervalSet.from_characters(u"_")
+            )
+        )
+
+    def test_property(self):
+        self.assertEqual(
+            parse(u"\\p{Lu}"),
+            CharacterClass(get_property(u"Lu"))
+        )
+        self.assertEqual(
+            parse(u"\\P{L}"),
+            CharacterClass(get_property(u"L").complement())
+        )
+
+    def test_unknown_property(self):
+        with self.assertRaises(ParserError) as context:
+            parse(u"\\p{Xy}")
+        exception = context.exception
+        self.assertEqual(exception.reason, u"unknown property Xy")
+        self.assertEqual(
+            exception.annotation,
+            (
+                u"\\p{Xy}\n"
+                u"  ^--^"
+            )
+        )
+
+    def test_ignore_case(self):
+        self.assertEqual(
+            parse(u"a", ignore_case=True),
+            Either(frozenset(map(Character, u"aA")))
+        )
+        self.assertEqual(parse(u"1", ignore_case=True), Character(u"1"))
+        self.assertEqual(
+            parse(u"[^a-c]", ignore_case=True),
+            CharacterClass(
+                IntervalSet([(0x41, 0x43), (0x61, 0x63)]).complement()
+            )
+        )
+
 
 class RegexTestWrapper(object):
-    def __init__(self, regex):
+    def __init__(self, regex, ignore_case=False):
         self.regex = regex
-        self.ast = parse(regex)
+        self.ast = parse(regex, ignore_case)
 
     @property
     def nfa(self):
@@ -233,6 +383,30 @@ class RegexTestWrapper(object):
             self._dfa_table = self.dfa.to_dfa_table()
         return self._dfa_table
 
+    @property
+    def position_automaton(self):
+        if not hasattr(self, "_position_automaton"):
+            self._position_automaton = self.ast.to_position_automaton()
+        return self._position_automaton
+
+    @property
+    def bit_parallel_nfa(self):
+        if not hasattr(self, "_bit_parallel_nfa"):
+            self._bit_parallel_nfa = self.ast.to_bit_parallel_nfa()
+        return self._bit_parallel_nfa
+
+    @property
+    def derivative_dfa(self):
+        if not hasattr(self, "_derivative_dfa"):
+            self._derivative_dfa = self.ast.to_derivative_dfa()
+        return self._derivative_dfa
+
+    @property
+    def optimized_nfa(self):
+        if not hasattr(self, "_optimized_nfa"):
+            self._optimized_nfa = self.ast.optimize().to_nfa()
+        return self._optimized_nfa
+
     @property
     def matchers(self):
         if hasattr(self, "_matchers"):
@@ -245,6 +419,14 @@ class RegexTestWrapper(object):
         yield matcher(self.nfa)
         yield matcher(self.dfa)
         yield matcher(self.dfa_table)
+        yield matcher(self.dfa_table.compress())
+        yield matcher(self.dfa_table.compress(chain=True))
+        yield matcher(self.optimized_nfa)
+        yield matcher(self.position_automaton)
+        yield matcher(self.position_automaton.to_dfa())
+        yield matcher(self.bit_parallel_nfa)
+        yield matcher(self.derivative_dfa)
+        yield matcher(self.derivative_dfa.to_dfa())
 
     def assertMatches(self, string, expected_end):
         for matcher in self.matchers:
@@ -553,6 +735,753 @@ class TestMatcher(TestCase):
             regex.assertSub(u"fafbf", u"e", (u"fefef", 2))
             regex.assertSub(u"fafbfcf", u"e", (u"fefefef", 3))
 
+    def test_long_epsilon_chain(self):
+        # every repetition adds epsilon moves to the chain, computing the
+        # closures recursively would exceed the recursion limit.
+        with self.regex(u"a*" * 400) as regex:
+            regex.assertAllMatches([(u"", 0), (u"a", 1), (u"aab", 2)])
+
+    def test_position_automaton(self):
+        automaton = parse(u"(ab|ac)*d").to_position_automaton()
+        # one state for each character and the initial state
+        self.assertEqual(len(automaton.characters), 6)
+        self.assertEqual(automaton.characters[1:], map(frozenset, u"abacd"))
+        self.assertEqual(automaton.follow, [
+            0b101010, 0b000100, 0b101010, 0b010000, 0b101010, 0b000000
+        ])
+        self.assertEqual(automaton.final_mask, 0b100000)
+
+    def test_default_transitions(self):
+        # any and neither use default transitions, instead of a transition
+        # for every character in the alphabet
+        nfa = parse(u".").to_nfa()
+        self.assertEqual(nfa.start.movements, {})
+        self.assertIs(nfa.start.default, nfa.final)
+        table = parse(u'"[^"]*"').compile()
+        self.assertLessEqual(sum(map(len, table.table)), 4)
+        self.assertEqual(table.match(u'"\u2603"'), 3)
+        with self.regex(u"[^a]b") as regex:
+            regex.assertMatches(u"\u2603b", 2)
+            regex.assertNotMatchesAny([u"ab", u"\u2603a"])
+
+    def test_counted_repetition(self):
+        with self.regex(u"(ab){1,2}c") as regex:
+            regex.assertAllMatches([(u"abc", 3), (u"ababc", 5)])
+            regex.assertNotMatchesAny([u"c", u"abababc"])
+        with self.regex(u"a{2,}") as regex:
+            regex.assertAllMatches([(u"aa", 2), (u"aaaaa", 5)])
+            regex.assertNotMatches(u"a")
+
+    def test_large_counted_repetition(self):
+        # large bounds are not expanded, the NFA counts instead.
+        regex = parse(u"(a|ab){20,40}c").compile()
+        self.assertIsInstance(regex, NFA)
+        self.assertEqual(regex.match(u"ab" * 20 + u"c"), 41)
+        self.assertEqual(regex.match(u"a" * 40 + u"c"), 41)
+        self.assertIsNone(regex.match(u"a" * 19 + u"c"))
+        self.assertIsNone(regex.match(u"a" * 41 + u"c"))
+        self.assertEqual(parse(u"a{20,}").compile().match(u"a" * 50), 50)
+
+    def test_region(self):
+        string = u"aab ab abb"
+        regex = RegexTestWrapper(u"ab*")
+        for matcher in regex.matchers:
+            self.assertEqual(matcher.match(string, 1), 3)
+            self.assertEqual(matcher.match(string, 1, 2), 2)
+            self.assertIsNone(matcher.match(string, 2))
+            self.assertEqual(
+                matcher.find(string, 2, 9),
+                Find(string, Span(4, 6))
+            )
+            self.assertEqual(
+                [find.span for find in matcher.find_all(string, 3, 9)],
+                [Span(4, 6), Span(7, 9)]
+            )
+            self.assertEqual(
+                matcher.subn(string, u"x", 3, 9),
+                (u"aab x xb", 2)
+            )
+            # negative positions are treated as 0
+            self.assertEqual(matcher.match(string, -3), 1)
+            self.assertEqual(
+                matcher.find(string, -2),
+                Find(string, Span(0, 1))
+            )
+            self.assertEqual(
+                matcher.subn(string, u"x", -3),
+                matcher.subn(string, u"x")
+            )
+            # regions ending before they start contain no matches
+            self.assertIsNone(matcher.find(string, 5, 2))
+            self.assertEqual(list(matcher.find_all(string, 5, 2)), [])
+            self.assertEqual(matcher.subn(string, u"x", 5, 2), (string, 0))
+        groups = parse(u"a(b*)").to_tagged_nfa()
+        self.assertEqual(
+            groups.find(string, 3).groups,
+            (Span(5, 6), )
+        )
+
+    def test_compressed_table(self):
+        words = [
+            u"and", u"as", u"assert", u"break", u"class", u"continue",
+            u"def", u"del", u"elif", u"else", u"except"
+        ]
+        table = compile_words(words)
+        for chain in [False, True]:
+            compressed = table.compress(chain)
+            # much smaller than a dense table with a column per character
+            self.assertLess(
+                compressed.get_size(),
+                len(table.table) * len(compressed.columns) / 2
+            )
+            for word in words:
+                self.assertEqual(compressed.match(word + u" "), len(word))
+            self.assertIsNone(compressed.match(u"brea"))
+            self.assertEqual(
+                compressed.transition(0, u"a"),
+                table.transition(0, u"a")
+            )
+            self.assertIsNone(compressed.transition(0, u"z"))
+        # rows of identifiers are chained to each other
+        table = parse(u"if|[a-z][a-z0-9]*").optimize().to_dfa_table()
+        compressed = table.compress(chain=True)
+        self.assertLess(compressed.get_size(), table.compress().get_size())
+        for string in [u"if", u"i", u"iff", u"x1"]:
+            self.assertEqual(compressed.match(string), table.match(string))
+
+    def test_bit_parallel(self):
+        regex = parse(u"(a|b)*a" + u"(a|b)" * 10).compile(bit_parallel=True)
+        self.assertIsInstance(regex, BitParallelNFA)
+        # 12 positions and the initial state, in blocks of 8 positions
+        self.assertEqual(map(len, regex._follow_tables), [256, 32])
+        self.assertEqual(regex.match(u"ba" + u"b" * 10), 12)
+        self.assertEqual(regex.match(u"ab" + u"b" * 10), 11)
+        self.assertIsNone(regex.match(u"b" * 12))
+
+    def test_character_classes(self):
+        with self.regex(u"\\w+") as regex:
+            regex.assertMatches(u"äb1_ c", 4)
+            regex.assertNotMatches(u" ")
+        with self.regex(u"\\p{Nd}[^\\s]") as regex:
+            regex.assertAllMatches([(u"1a", 2), (u"٣٣", 2)])
+            regex.assertNotMatchesAny([u"a1", u"1 "])
+        # classes are kept as intervals, the table has one transition per
+        # interval instead of one per character
+        table = parse(u"\\w").compile()
+        self.assertEqual(table.match(u"ж"), 1)
+        self.assertLess(sum(map(len, table.table)), 10)
+
+    def test_ignore_case(self):
+        regex = RegexTestWrapper(u"straße|[k-m]+|\\p{Lu}σ", ignore_case=True)
+        regex.assertAllMatches([
+            (u"STRAßE", 6), (u"lKm", 3), (u"\u212a", 1), (u"aΣ", 2),
+            (u"ΣΣς", 2)
+        ])
+        regex.assertNotMatchesAny([u"STRASSE", u"1σ"])
+        regex = RegexTestWrapper(u"[^a]", ignore_case=True)
+        regex.assertNotMatchesAny([u"a", u"A"])
+
+
+class TestIntervalSet(TestCase):
+    def test_operations(self):
+        a = IntervalSet([(0x61, 0x66), (0x78, 0x7a)])
+        b = IntervalSet.from_range(u"c", u"y")
+        self.assertEqual(a | b, IntervalSet([(0x61, 0x7a)]))
+        self.assertEqual(a & b, IntervalSet([(0x63, 0x66), (0x78, 0x79)]))
+        self.assertEqual(a - b, IntervalSet([(0x61, 0x62), (0x7a, 0x7a)]))
+        self.assertEqual(a.complement().complement(), a)
+        self.assertIn(u"x", a)
+        self.assertNotIn(u"g", a)
+        self.assertEqual(len(a), 9)
+
+
+class TestSub(TestCase):
+    def test_subn_to(self):
+        matcher = parse(u"ab*").compile()
+        file = StringIO()
+        self.assertEqual(matcher.subn_to(file, u"xabbxa", u"-"), 2)
+        self.assertEqual(file.getvalue(), u"x-x-")
+
+    def test_iter_sub(self):
+        matcher = parse(u"ab*").compile()
+        self.assertEqual(
+            list(matcher.iter_sub(u"xabbxa", u"-")),
+            [u"x", u"-", u"x", u"-", u""]
+        )
+
+
+class TestLineIndex(TestCase):
+    def test_get_position(self):
+        index = LineIndex(u"ab\ncd\n\ne")
+        self.assertEqual(index.line_starts, [0, 3, 6, 7])
+        self.assertEqual(index.get_position(0), (0, 0))
+        self.assertEqual(index.get_position(2), (0, 2))
+        self.assertEqual(index.get_position(4), (1, 1))
+        self.assertEqual(index.get_position(6), (2, 0))
+        self.assertEqual(index.get_position(7), (3, 0))
+
+    def test_find(self):
+        string = u"ab\ncab\n  ab"
+        finds = list(parse(u"ab").compile().find_all(string))
+        self.assertEqual(
+            [(find.line, find.column) for find in finds],
+            [(0, 0), (1, 1), (2, 2)]
+        )
+        # all finds in a string share the index
+        self.assertIs(finds[0].line_index, finds[-1].line_index)
+        # finds in other strings do not replace it
+        other = list(parse(u"ab").compile().find_all(u"\nab"))
+        self.assertEqual(other[0].position, (1, 0))
+        self.assertIsNot(other[0].line_index, finds[0].line_index)
+        self.assertEqual(finds[1].position, (1, 1))
+
+    def test_token(self):
+        tokenizer = Tokenizer([(u"a+", Token), (u"\n", Token)])
+        tokens = list(tokenizer(u"a\naa\n\na"))
+        self.assertEqual(
+            [(token.line, token.column) for token in tokens],
+            [(0, 0), (0, 1), (1, 0), (1, 2), (2, 0), (3, 0)]
+        )
+        with self.assertRaises(ValueError):
+            Token(u"a", Span(0, 1)).position
+
+
+class TestGroups(TestCase):
+    def test_spans(self):
+        nfa = parse(u"(a+)(b*)c").to_tagged_nfa()
+        self.assertEqual(nfa.groups, 2)
+        self.assertEqual(
+            nfa.match_groups(u"aabbc"),
+            (5, (Span(0, 2), Span(2, 4)))
+        )
+        self.assertEqual(nfa.match_groups(u"b"), (None, None))
+
+    def test_find(self):
+        nfa = parse(u"(a)|(b)").to_tagged_nfa()
+        find = nfa.find(u"xb")
+        self.assertEqual(find, Find(u"xb", Span(1, 2), (None, Span(1, 2))))
+        self.assertEqual(find.group(), u"b")
+        self.assertIsNone(find.group(1))
+        self.assertEqual(find.group(2), u"b")
+
+    def test_priority(self):
+        # the left alternative is preferred, among matches of equal length
+        nfa = parse(u"(a|ab)(c|bcd)").to_tagged_nfa()
+        self.assertEqual(
+            nfa.match_groups(u"abcd"),
+            (4, (Span(0, 1), Span(1, 4)))
+        )
+
+    def test_repetitions(self):
+        # repeated groups report their last repetition
+        nfa = parse(u"((a)(b))+").to_tagged_nfa()
+        self.assertEqual(nfa.groups, 3)
+        self.assertEqual(
+            nfa.match_groups(u"abab"),
+            (4, (Span(2, 4), Span(2, 3), Span(3, 4)))
+        )
+        # an explicit repetition has groups of its own
+        nfa = parse(u"(a)(a)*").to_tagged_nfa()
+        self.assertEqual(nfa.groups, 2)
+        self.assertEqual(
+            nfa.match_groups(u"aaa"),
+            (3, (Span(0, 1), Span(2, 3)))
+        )
+        nfa = parse(u"(a){20,30}(b)").to_tagged_nfa()
+        self.assertEqual(
+            nfa.match_groups(u"a" * 25 + u"b"),
+            (26, (Span(24, 25), Span(25, 26)))
+        )
+
+    def test_long_epsilon_chain(self):
+        nfa = parse(u"(a*)" * 400).to_tagged_nfa()
+        end, groups = nfa.match_groups(u"aab")
+        self.assertEqual(end, 2)
+        self.assertEqual(groups[0], Span(0, 2))
+        self.assertEqual(groups[-1], Span(2, 2))
+
+
+class TestOptimize(TestCase):
+    def test_flatten(self):
+        a, b, c = map(Character, u"abc")
+        self.assertEqual(parse(u"abc").optimize(), Concatenation(a, b, c))
+        self.assertEqual(
+            parse(u"a*|b*|c*").optimize(),
+            Union(Repetition(a), Repetition(b), Repetition(c))
+        )
+
+    def test_merge_characters(self):
+        self.assertEqual(
+            parse(u"a|[bc]|d*").optimize(),
+            Union(
+                Either(frozenset(map(Character, u"abc"))),
+                Repetition(Character(u"d"))
+            )
+        )
+
+    def test_groups(self):
+        self.assertEqual(parse(u"((a))").optimize(), Character(u"a"))
+
+    def test_repetitions(self):
+        a = Character(u"a")
+        self.assertEqual(parse(u"(a*)*").optimize(), Repetition(a))
+        self.assertEqual(parse(u"a*a*").optimize(), Repetition(a))
+        self.assertEqual(parse(u"(|a)*").optimize(), Repetition(a))
+
+    def test_common_prefixes(self):
+        a, b, c, d = map(Character, u"abcd")
+        self.assertEqual(
+            parse(u"abc|abd|a").optimize(),
+            Concatenation(
+                a,
+                Union(
+                    Concatenation(b, Either(frozenset([c, d]))),
+                    Epsilon()
+                )
+            )
+        )
+
+
+class TestInterning(TestCase):
+    def test_identity(self):
+        self.assertIs(Character(u"a"), Character(u"a"))
+        self.assertIs(
+            Union(Character(u"a"), Character(u"b")),
+            Union(Character(u"a"), Character(u"b"))
+        )
+        self.assertIsNot(
+            Union(Character(u"a"), Character(u"b")),
+            Concatenation(Character(u"a"), Character(u"b"))
+        )
+
+    def test_shared_subexpressions(self):
+        regex = parse(u"(ab)+")
+        self.assertIs(regex.operands[0], regex.operands[1].repeated)
+
+    def test_simplification(self):
+        ab = Concatenation(Character(u"a"), Character(u"b"))
+        self.assertIs(Concatenation(Epsilon(), ab), ab)
+        self.assertEqual(ab.operands, (Character(u"a"), Character(u"b")))
+
+
+class TestDerivatives(TestCase):
+    def test_concatenate(self):
+        a, b, c = map(Character, u"abc")
+        self.assertEqual(
+            concatenate(Concatenation(a, b), c),
+            Concatenation(a, b, c)
+        )
+        self.assertEqual(concatenate(Epsilon(), a), a)
+        self.assertEqual(concatenate(a, Empty()), Empty())
+
+    def test_union(self):
+        a, b = map(Character, u"ab")
+        self.assertEqual(union(a, union(b, a)), union(b, a))
+        self.assertEqual(union(a, Empty()), a)
+        self.assertEqual(union(Empty(), Empty()), Empty())
+        # alternatives are ordered by their structure, not by their hashes
+        self.assertEqual(union(b, a).operands, (a, b))
+        self.assertEqual(
+            union(Repetition(b), a, Repetition(a)).operands,
+            (a, Repetition(a), Repetition(b))
+        )
+
+    def test_repeat(self):
+        a = Character(u"a")
+        self.assertEqual(repeat(repeat(a)), Repetition(a))
+        self.assertEqual(repeat(Empty()), Epsilon())
+
+    def test_derive(self):
+        regex = parse(u"ab*")
+        self.assertEqual(regex.derive(u"a"), Repetition(Character(u"b")))
+        self.assertEqual(regex.derive(u"b"), Empty())
+
+    def test_to_dfa(self):
+        dfa = parse(u"(a|b)*abb").to_derivative_dfa().to_dfa()
+        dfa_table = dfa.to_dfa_table()
+        self.assertEqual(len(dfa_table.table), 4)
+
+
+class TestWords(TestCase):
+    def test_compile_words(self):
+        words = [u"tap", u"taps", u"top", u"tops"]
+        dfa_table = compile_words(words)
+        for word in words:
+            self.assertEqual(dfa_table.match(word), len(word))
+        self.assertEqual(dfa_table.match(u"tapsx"), 4)
+        self.assertIsNone(dfa_table.match(u"to"))
+        # the minimal automaton shares the states after "ta" and "to"
+        self.assertEqual(len(dfa_table.table), 5)
+
+    def test_empty_word(self):
+        dfa = compile_words([u"", u"a"], table=False)
+        self.assertEqual(dfa.match(u""), 0)
+        self.assertEqual(dfa.match(u"a"), 1)
+
+    def test_unsorted(self):
+        with self.assertRaises(ValueError):
+            compile_words([u"b", u"a"])
+
+    def test_tokenizer(self):
+        class Keyword(Token):
+            pass
+        class Name(Token):
+            pass
+        class Space(Token):
+            pass
+        tokenizer = Tokenizer([
+            (compile_words([u"for", u"if", u"in"]), Keyword),
+            (u"[a-z]+", Name),
+            (u" ", Space)
+        ])
+        self.assertEqual(list(tokenizer(u"for x")), [
+            Keyword(u"for", Span(0, 3)),
+            Space(u" ", Span(3, 4)),
+            Name(u"x", Span(4, 5))
+        ])
+
+
+class TestRegexSet(TestCase):
+    def test_match(self):
+        regexes = RegexSet([u"ab*", u"b+c", u"abc", u"(a|b)*"])
+        self.assertEqual(regexes.match(u"abc"), {0: 2, 2: 3, 3: 2})
+        self.assertEqual(regexes.match(u"bbc"), {1: 3, 3: 2})
+        self.assertEqual(regexes.match(u"c"), {})
+        self.assertEqual(regexes.match(u""), {3: 0})
+
+    def test_scan(self):
+        regexes = RegexSet([u"ab", u"b+c", u"x"])
+        self.assertEqual(list(regexes.scan(u"abcxbbc")), [
+            (2, frozenset([0])),
+            (3, frozenset([1])),
+            (4, frozenset([2])),
+            (7, frozenset([1]))
+        ])
+        self.assertEqual(regexes.matching(u"zzbcz"), set([1]))
+
+    def test_lazy(self):
+        regexes = RegexSet([u"[a-z]*%d" % i for i in xrange(100)])
+        self.assertEqual(regexes.match(u"x42"), {4: 2, 42: 3})
+        # only the states for the prefixes of "x42" have been constructed
+        self.assertEqual(len(regexes._anchored.closures), 4)
+
+    def test_counted_repetition(self):
+        regexes = RegexSet([u"a{20}", u"a{2,30}b", u"b"])
+        self.assertEqual(regexes.match(u"a" * 25), {0: 20})
+        self.assertEqual(regexes.match(u"a" * 25 + u"b"), {0: 20, 1: 26})
+        self.assertEqual(regexes.match(u"a" * 31 + u"b"), {0: 20})
+        self.assertEqual(regexes.matching(u"ab"), set([2]))
+
+
+class TestStream(TestCase):
+    def test_iter_finds(self):
+        chunks = [u"xab", u"bbxa", u"", u"bx"]
+        string = u"".join(chunks)
+        expected = list(parse(u"ab*").compile().find_all(string))
+        finds = list(iter_finds(u"ab*", chunks))
+        self.assertEqual(
+            [(find.match, find.span) for find in finds],
+            [(find.match, find.span) for find in expected]
+        )
+
+    def test_feed(self):
+        searcher = StreamSearcher(u"ab*")
+        self.assertEqual(searcher.feed(u"xab"), [])
+        # the match may continue with the next chunk
+        self.assertEqual(
+            searcher.feed(u"bx"),
+            [StreamFind(u"abb", Span(1, 4))]
+        )
+        self.assertEqual(searcher.close(), [])
+
+    def test_empty_matches(self):
+        finds = list(iter_finds(u"a*", [u"b", u"aa", u"b"]))
+        self.assertEqual(finds, [StreamFind(u"aa", Span(1, 3))])
+        finds = list(iter_finds(u"", [u"a"]))
+        self.assertEqual(finds, [StreamFind(u"", Span(1, 1))])
+
+    def test_counted_repetition(self):
+        chunks = [u"b" + u"a" * 10, u"a" * 15 + u"b", u"a" * 5 + u"b"]
+        string = u"".join(chunks)
+        expected = list(parse(u"a{20,30}").compile().find_all(string))
+        finds = list(iter_finds(u"a{20,30}", chunks))
+        self.assertEqual(finds, [StreamFind(u"a" * 25, Span(1, 26))])
+        self.assertEqual(
+            [find.span for find in finds],
+            [find.span for find in expected]
+        )
+
+    def test_iter_sub(self):
+        chunks = iter_sub(u"ab*", [u"xab", u"bbxa", u"", u"bx"], u"-")
+        self.assertEqual(u"".join(chunks), u"x-x-x")
+        chunks = iter_sub(
+            u"a+", [u"baa", u"ab"], lambda find: unicode(find.span.start)
+        )
+        self.assertEqual(u"".join(chunks), u"b1b")
+
+    def test_max_lookback(self):
+        searcher = StreamSearcher(u"a*b", max_lookback=4)
+        searcher.feed(u"aaa")
+        with self.assertRaises(StreamError) as context:
+            searcher.feed(u"aa")
+        self.assertEqual(context.exception.position, 0)
+
+
+class TestBackward(TestCase):
+    def test_reverse(self):
+        self.assertEqual(parse(u"a(bc)*|d").reverse(), parse(u"(cb)*a|d"))
+
+    def test_find_before(self):
+        searcher = BackwardSearcher(u"ab*")
+        string = u"abb ab a"
+        self.assertEqual(
+            searcher.find_before(string),
+            Find(string, Span(7, 8))
+        )
+        self.assertEqual(
+            searcher.find_before(string, 7),
+            Find(string, Span(4, 6))
+        )
+        # the match is cut off at the position
+        self.assertEqual(
+            searcher.find_before(string, 2),
+            Find(string, Span(0, 2))
+        )
+        self.assertIsNone(searcher.find_before(string, 0))
+
+    def test_counted_repetition(self):
+        searcher = BackwardSearcher(u"a{20,30}")
+        string = u"a" * 25 + u"b" + u"a" * 19 + u"b"
+        self.assertEqual(
+            searcher.find_before(string),
+            Find(string, Span(5, 25))
+        )
+        self.assertEqual(
+            searcher.find_before(string, 22),
+            Find(string, Span(2, 22))
+        )
+        self.assertIsNone(searcher.find_before(string, 10))
+
+    def test_same_as_forward(self):
+        searcher = BackwardSearcher(u"(ab)+c?|a*")
+        matcher = parse(u"(ab)+c?|a*").compile()
+        string = u"xababcaab"
+        for position in xrange(len(string) + 1):
+            find = searcher.find_before(string, position)
+            start = -1 if find is None else find.span.start
+            for offset in xrange(start + 1, position):
+                self.assertIsNone(matcher.match(string[offset:position]))
+            if find is not None:
+                self.assertEqual(
+                    matcher.find(string[:position], start).span,
+                    find.span
+                )
+
+
+class StreamToken(Token):
+    pass
+
+
+class LengthToken(Token):
+    def __init__(self, lexeme, span):
+        Token.__init__(self, lexeme, span)
+        self.length = len(lexeme)
+
+
+class TestTokenStream(TestCase):
+    def test_stream(self):
+        tokenizer = Tokenizer([(u"a+", StreamToken), (u"\n", Token)])
+        string = u"aa\na"
+        stream = tokenizer.tokenize_to_stream(string)
+        self.assertEqual(list(stream.ids), [0, 1, 0])
+        self.assertEqual(list(stream.starts), [0, 2, 3])
+        self.assertEqual(list(stream.ends), [2, 3, 4])
+        self.assertEqual(list(stream), list(tokenizer(string)))
+        self.assertIsInstance(stream[0], StreamToken)
+        self.assertEqual(stream[-1].position, (1, 0))
+        self.assertEqual(stream.get_lexeme(0), u"aa")
+
+    def test_token_class(self):
+        # token classes need not accept a line index
+        tokenizer = Tokenizer([(u"a+", LengthToken), (u"\n", Token)])
+        string = u"aa\na"
+        stream = tokenizer.tokenize_to_stream(string)
+        self.assertEqual(list(stream), list(tokenizer(string)))
+        self.assertEqual(stream[0].length, 2)
+        self.assertEqual(stream[2].position, (1, 0))
+
+    def test_pickle(self):
+        tokenizer = Tokenizer([(u"a+", StreamToken), (u"b+", Token)])
+        stream = tokenizer.tokenize_to_stream(u"aabba")
+        stream[0].position
+        unpickled = pickle.loads(pickle.dumps(stream, 2))
+        self.assertEqual(list(unpickled), list(stream))
+        self.assertEqual(unpickled.ids, stream.ids)
+
+    def test_parallel(self):
+        tokenizer = Tokenizer([
+            (u"[a-z]+", Token), (u"[ \n]+", Token), (u'"[^"]*"', Token)
+        ])
+        # tokens crossing the newlines, at which the string is split
+        string = u'ab "c\nd"\nef\n\n"\n" gh\n' * 4
+        for chunk_size in [1, 3, 7, 100]:
+            stream = tokenizer.tokenize_in_parallel(string, 2, chunk_size)
+            self.assertEqual(list(stream), list(tokenizer(string)))
+        with self.assertRaises(TokenizerError) as context:
+            tokenizer.tokenize_in_parallel(string + u'!\n"\n', 2, 3)
+        self.assertEqual(context.exception.position, len(string))
+
+
+class TestBackground(TestCase):
+    def setUp(self):
+        self.pool = ThreadPool(1)
+        # blocks the pool, until the event is set
+        self.event = Event()
+        self.pool.apply_async(self.event.wait)
+
+    def tearDown(self):
+        self.event.set()
+        self.pool.close()
+        self.pool.join()
+
+    def test_fallback(self):
+        matcher = BackgroundMatcher(u"a+b", self.pool)
+        self.assertFalse(matcher.is_compiled)
+        self.assertIsInstance(matcher.matcher, NFA)
+        self.assertEqual(matcher.match(u"aab"), 3)
+        self.event.set()
+        self.assertIsInstance(matcher.wait(), DFATable)
+        self.assertIsInstance(matcher.matcher, DFATable)
+        self.assertEqual(matcher.find(u"caab"), Find(u"caab", Span(1, 4)))
+
+    def test_wait(self):
+        matcher = BackgroundMatcher(u"a+b", self.pool, fallback=False)
+        # the pool is blocked, so the regex is compiled by the waiting thread
+        self.assertIsInstance(matcher.matcher, DFATable)
+        self.assertTrue(matcher.is_compiled)
+        self.assertEqual(matcher.match(u"aab"), 3)
+
+    def test_error(self):
+        class Invalid(object):
+            def compile(self):
+                raise ValueError()
+        matcher = BackgroundMatcher(Invalid(), self.pool)
+        self.event.set()
+        self.pool.close()
+        self.pool.join()
+        self.assertFalse(matcher.is_compiled)
+        with self.assertRaises(ValueError):
+            matcher.wait()
+
+    def test_tokenizer(self):
+        tokenizer = Tokenizer([(u"a+", Token), (u"b+", Token)], self.pool)
+        self.event.set()
+        self.assertEqual(list(tokenizer(u"aab")), [
+            Token(u"aa", Span(0, 2)),
+            Token(u"b", Span(2, 3))
+        ])
+
+    def test_parser_error(self):
+        with self.assertRaises(ParserError):
+            BackgroundMatcher(u"(a", self.pool)
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "b"))
+        for path, content in [
+            ("a", u"foo\nbar\nbaz\n"),
+            ("b/c", u"abc\nxyz\n"),
+            ("b/d", u"ä\nba\n")
+        ]:
+            with open(os.path.join(self.directory, path), "wb") as file:
+                file.write(content.encode("utf-8"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_search(self):
+        join = lambda *parts: os.path.join(self.directory, *parts)
+        expected = [
+            (join("a"), 2, u"bar"),
+            (join("a"), 3, u"baz"),
+            (join("b", "c"), 1, u"abc"),
+            (join("b", "d"), 2, u"ba")
+        ]
+        results = search(u"ba|bc", [self.directory], jobs=2)
+        self.assertEqual(list(results), expected)
+        results = search(u"ba|bc", [self.directory], jobs=2, ordered=False)
+        self.assertEqual(sorted(results), expected)
+        results = search(u"ä", [join("b", "d")], jobs=1)
+        self.assertEqual(list(results), [(join("b", "d"), 1, u"ä")])
+        results = search(u"z{20}|a(b|x)", [self.directory], jobs=1)
+        self.assertEqual(list(results), [(join("b", "c"), 1, u"abc")])
+
+    def test_unreadable(self):
+        missing = os.path.join(self.directory, "missing")
+        paths = [missing, os.path.join(self.directory, "a")]
+        with self.assertRaises(IOError) as context:
+            list(search(u"foo", paths, jobs=1))
+        self.assertEqual(context.exception.filename, missing)
+        errors = []
+        results = search(
+            u"foo", paths, jobs=1,
+            on_error=lambda path, error: errors.append(path)
+        )
+        self.assertEqual(
+            list(results), [(os.path.join(self.directory, "a"), 1, u"foo")]
+        )
+        self.assertEqual(errors, [missing])
+
+
+class TestTrigram(TestCase):
+    def test_get_query(self):
+        query = lambda regex: get_query(parse(regex))
+        self.assertEqual(
+            query(u"abcd"),
+            And(Trigram(u"abc"), Trigram(u"bcd"))
+        )
+        self.assertEqual(
+            query(u"abc|def"),
+            Or(Trigram(u"abc"), Trigram(u"def"))
+        )
+        self.assertEqual(
+            query(u"abc.*def"),
+            And(Trigram(u"abc"), Trigram(u"def"))
+        )
+        self.assertEqual(query(u"[a-z]+foo"), Trigram(u"foo"))
+        self.assertEqual(query(u"ab"), All())
+        self.assertEqual(query(u"(abc)*"), All())
+
+    def test_index(self):
+        directory = tempfile.mkdtemp()
+        try:
+            documents = [u"hello world", u"abc def", u"world abcd", u"ä"]
+            paths = []
+            for i, document in enumerate(documents):
+                paths.append(os.path.join(directory, str(i)))
+                with open(paths[-1], "wb") as file:
+                    file.write(document.encode("utf-8"))
+            index_path = os.path.join(directory, "index")
+            with open(index_path, "wb") as file:
+                write_index(izip(paths, documents), file)
+            index = TrigramIndex(index_path)
+            self.assertEqual(index.documents, paths)
+            self.assertEqual(list(index.get_postings(u"wor")), [0, 2])
+            self.assertEqual(list(index.get_postings(u"xyz")), [])
+            self.assertEqual(
+                index.get_candidates(u"world|abc"), paths[:3]
+            )
+            self.assertEqual(index.get_candidates(u"abcd"), paths[2:3])
+            self.assertEqual(
+                [(name, find.span) for name, find in index.search(u"abc")],
+                [(paths[1], Span(0, 3)), (paths[2], Span(6, 9))]
+            )
+            index.close()
+        finally:
+            shutil.rmtree(directory)
+
 
 class TestTokenizer(TestCase):
     def runTest(self):
@@ -584,3 +1513,22 @@ class TestTokenizer(TestCase):
         )
         self.assertEqual(exception.position, 8)
         self.assertEqual(string[exception.position], u"c")
+
+        with self.assertRaises(TokenizerError) as context:
+            tokenizer.tokenize_to_stream(string)
+        self.assertEqual(context.exception.position, 8)
+
+        # the region ends before the unconsumable character
+        self.assertEqual(list(tokenizer(string, 1, 8)), [
+            B(u"b", Span(1, 2)),
+            AB(u"ab", Span(2, 4)),
+            A(u"aa", Span(4, 6)),
+            B(u"bb", Span(6, 8))
+        ])
+        # negative positions are treated as 0
+        self.assertEqual(
+            list(tokenizer(string, -1, 2)),
+            [AB(u"ab", Span(0, 2))]
+        )
+        self.assertEqual(list(tokenizer(string, 4, 2)), [])
+        self.assertEqual(len(tokenizer.tokenize_to_stream(string, 4, 2)), 0)
@@ -6,8 +6,63 @@
     :copyright: 2012 by Daniel Neuhäuser
     :license: BSD, see LICENSE.rst
 """
+from array import array
+from bisect import bisect_left
+from itertools import izip
+from multiprocessing import Pool, cpu_count
+
 from regex.parser import parse
-from regex.matcher import Span
+from regex.matcher import MatcherBase, Span, LineIndex, get_region
+from regex.background import BackgroundMatcher
+
+
+#: The tokenizer and string used by the worker processes of
+#: :meth:`Tokenizer.tokenize_in_parallel`, set by :func:`_initialize`.
+_tokenizer = None
+_string = None
+
+
+def _initialize(tokenizer, string):
+    global _tokenizer, _string
+    _tokenizer, _string = tokenizer, string
+
+
+def _tokenize_chunk(chunk):
+    # tokenizes from the start of the chunk, which need not be the start of
+    # a token in a sequential run, until a token ends at or after the end of
+    # the chunk. Returns the arrays of the tokens and the position at which
+    # tokenizing failed or `None`.
+    start, end = chunk
+    ids = array("i")
+    starts = array("l")
+    ends = array("l")
+    pos = start
+    while pos < end:
+        id, token_end = _tokenizer._match(_string, pos, None)
+        if id is None:
+            return ids, starts, ends, pos
+        ids.append(id)
+        starts.append(pos)
+        ends.append(token_end)
+        pos = token_end
+    return ids, starts, ends, None
+
+
+def get_chunks(string, chunk_size):
+    """
+    Returns a list of ``(start, end)`` pairs splitting `string` into chunks
+    of at least `chunk_size` characters, each but the last ending after a
+    newline.
+    """
+    chunks = []
+    start = 0
+    while start < len(string):
+        end = string.find(u"\n", start + chunk_size - 1) + 1
+        if end == 0:
+            end = len(string)
+        chunks.append((start, end))
+        start = end
+    return chunks
 
 
 class TokenizerError(Exception):
@@ -18,9 +73,29 @@ class TokenizerError(Exception):
 
 
 class Token(object):
-    def __init__(self, lexeme, span):
+    def __init__(self, lexeme, span, line_index=None):
         self.lexeme = lexeme
         self.span = span
+        #: A :class:`LineIndex` for the tokenized string, set by the
+        #: tokenizer.
+        self.line_index = line_index
+
+    @property
+    def position(self):
+        """
+        The line and column at which the token starts, both starting at 0.
+        """
+        if self.line_index is None:
+            raise ValueError("token has no line index")
+        return self.line_index.get_position(self.span.start)
+
+    @property
+    def line(self):
+        return self.position[0]
+
+    @property
+    def column(self):
+        return self.position[1]
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -35,29 +110,200 @@ class Token(object):
 
 
 class Tokenizer(object):
-    def __init__(self, definitions):
+    """
+    Splits strings into tokens.
+
+    :param definitions: A list of ``(regex, token_cls)`` pairs, `regex` is
+                        either a regex string or a matcher, e.g. one returned
+                        by :func:`regex.words.compile_words`.
+    :param pool: A pool of threads or processes, if given, the regex strings
+                 are compiled in the background by it, see
+                 :class:`regex.background.BackgroundMatcher`.
+    """
+    def __init__(self, definitions, pool=None):
         self.definitions = []
         for regex, token_cls in definitions:
-            self.definitions.append((parse(regex).compile(), token_cls))
+            if not isinstance(regex, MatcherBase):
+                if pool is None:
+                    regex = parse(regex).compile()
+                else:
+                    regex = BackgroundMatcher(regex, pool)
+            self.definitions.append((regex, token_cls))
 
-    def __call__(self, string):
-        start = 0
-        while string:
-            token = self.match_token(string, start)
+    def __call__(self, string, pos=0, endpos=None):
+        """
+        Yields the tokens in ``string[pos:endpos]``, without copying the
+        string. The spans of the tokens are relative to the beginning of
+        `string`.
+        """
+        pos, endpos = get_region(string, pos, endpos)
+        line_index = LineIndex(string)
+        while pos < endpos:
+            token = self.match_token(string, pos, endpos)
             if token is None:
                 raise TokenizerError(
-                    "string cannot be further consumed at position %d" % start,
-                    start
+                    "string cannot be further consumed at position %d" % pos,
+                    pos
                 )
-            token, string, start = token
+            token.line_index = line_index
+            pos = token.span.end
             yield token
 
-    def match_token(self, string, start=0):
-        for matcher, token_cls in self.definitions:
-            end = matcher.match(string)
-            if end is not None:
-                return (
-                    token_cls(string[:end], Span(start, start + end)),
-                    string[end:],
-                    start + end
+    def tokenize_to_stream(self, string, pos=0, endpos=None):
+        """
+        Returns a :class:`TokenStream` of the tokens in
+        ``string[pos:endpos]``. Unlike calling the tokenizer, no object is
+        created per token.
+        """
+        pos, endpos = get_region(string, pos, endpos)
+        ids = array("i")
+        starts = array("l")
+        ends = array("l")
+        while pos < endpos:
+            id, end = self._match(string, pos, endpos)
+            if id is None:
+                raise TokenizerError(
+                    "string cannot be further consumed at position %d" % pos,
+                    pos
                 )
+            ids.append(id)
+            starts.append(pos)
+            ends.append(end)
+            pos = end
+        return TokenStream(
+            string, [token_cls for _, token_cls in self.definitions],
+            ids, starts, ends
+        )
+
+    def tokenize_in_parallel(self, string, jobs=None, chunk_size=None):
+        """
+        Returns the same :class:`TokenStream` as :meth:`tokenize_to_stream`
+        for `string`, tokenized by `jobs` processes - as many as there are
+        CPUs if `None`.
+
+        The string is split into chunks after newlines and every chunk is
+        tokenized by a worker process, starting at the beginning of the
+        chunk. As the tokens following a position depend on nothing but the
+        position, the tokens of a chunk are those of a sequential run from
+        the first position, at which both have a token start. When the
+        chunks are merged in order, tokens crossing the beginning of a chunk
+        are tokenized again until such a position is reached, which -
+        splitting after newlines - is usually right away.
+
+        By default the string is split into four chunks per process.
+        """
+        if jobs is None:
+            jobs = cpu_count()
+        if chunk_size is None:
+            chunk_size = max(len(string) // (4 * jobs), 1)
+        ids = array("i")
+        starts = array("l")
+        ends = array("l")
+        pos = 0
+        chunks = get_chunks(string, chunk_size)
+        pool = Pool(jobs, _initialize, (self, string))
+        try:
+            results = pool.imap(_tokenize_chunk, chunks)
+            for (_, end), chunk in izip(chunks, results):
+                chunk_ids, chunk_starts, chunk_ends, error = chunk
+                while pos < end:
+                    i = bisect_left(chunk_starts, pos)
+                    if i < len(chunk_starts) and chunk_starts[i] == pos:
+                        # synchronized with the chunk
+                        ids.extend(chunk_ids[i:])
+                        starts.extend(chunk_starts[i:])
+                        ends.extend(chunk_ends[i:])
+                        pos = chunk_ends[-1]
+                        if error is not None:
+                            pos = error
+                            break
+                        continue
+                    id, token_end = self._match(string, pos, None)
+                    if id is None:
+                        break
+                    ids.append(id)
+                    starts.append(pos)
+                    ends.append(token_end)
+                    pos = token_end
+                if pos < end:
+                    raise TokenizerError(
+                        "string cannot be further consumed at position %d" %
+                        pos,
+                        pos
+                    )
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return TokenStream(
+            string, [token_cls for _, token_cls in self.definitions],
+            ids, starts, ends
+        )
+
+    def match_token(self, string, pos=0, endpos=None):
+        pos, endpos = get_region(string, pos, endpos)
+        id, end = self._match(string, pos, endpos)
+        if id is not None:
+            token_cls = self.definitions[id][1]
+            return token_cls(string[pos:end], Span(pos, end))
+
+    def _match(self, string, pos, endpos):
+        # returns the index of the first matching definition and the end of
+        # the match or a pair of `None`s
+        for id, (matcher, _) in enumerate(self.definitions):
+            end = matcher.match(string, pos, endpos)
+            if end is not None:
+                return id, end
+        return None, None
+
+
+class TokenStream(object):
+    """
+    The tokens of `string` stored in three arrays: `ids` contains the index
+    of the definition - and its token class in `token_classes` - that
+    matched each token, `starts` and `ends` the span of each token.
+
+    :class:`Token`\s and their lexemes are only created, when they are
+    accessed. Streams can be pickled, the token classes are pickled by
+    reference.
+    """
+    def __init__(self, string, token_classes, ids, starts, ends):
+        self.string = string
+        self.token_classes = token_classes
+        self.ids = ids
+        self.starts = starts
+        self.ends = ends
+
+    @property
+    def line_index(self):
+        if not hasattr(self, "_line_index"):
+            self._line_index = LineIndex(self.string)
+        return self._line_index
+
+    def get_lexeme(self, i):
+        return self.string[self.starts[i]:self.ends[i]]
+
+    def get_span(self, i):
+        return Span(self.starts[i], self.ends[i])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        token_cls = self.token_classes[self.ids[i]]
+        # tokens are constructed like the tokenizer constructs them, so that
+        # token classes need not accept a line index
+        token = token_cls(self.get_lexeme(i), self.get_span(i))
+        token.line_index = self.line_index
+        return token
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_line_index", None)
+        return state
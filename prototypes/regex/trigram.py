@@ -0,0 +1,445 @@
+# coding: utf-8
+"""
+    regex.trigram
+    ~~~~~~~~~~~~~
+
+    A trigram index over a corpus of documents, which is used to search the
+    corpus for matches of a regex without running the automaton on every
+    document.
+
+    A query of the trigrams any match of the regex must contain is derived
+    from the regex, following the approach used by Google Code Search. Only
+    the documents satisfying the query are searched.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+import mmap
+import struct
+from array import array
+from itertools import product
+
+from regex.parser import parse
+from regex.search import read_text
+from regex.ast import (
+    Epsilon, Character, Concatenation, Union, CountedRepetition, Group,
+    Either, Range
+)
+
+
+#: Sets of strings with more strings than this are not tracked exactly but
+#: approximated by the trigrams they contain.
+MAX_STRINGS = 16
+
+
+def iter_trigrams(string):
+    for i in xrange(len(string) - 2):
+        yield string[i:i + 3]
+
+
+class Query(object):
+    """
+    A boolean query of trigrams, that determines which documents may contain
+    a match.
+    """
+    def evaluate(self, index):
+        """
+        Returns the set of ids of the documents in `index`, that satisfy this
+        query.
+        """
+        raise NotImplementedError()
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class All(Query):
+    """
+    Satisfied by every document.
+    """
+    def evaluate(self, index):
+        return set(xrange(len(index.documents)))
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__)
+
+    def __hash__(self):
+        return hash(self.__class__)
+
+    def __repr__(self):
+        return "%s()" % self.__class__.__name__
+
+
+class Trigram(Query):
+    """
+    Satisfied by the documents containing `trigram`.
+    """
+    def __init__(self, trigram):
+        self.trigram = trigram
+
+    def evaluate(self, index):
+        return set(index.get_postings(self.trigram))
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.trigram == other.trigram
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.trigram)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.trigram)
+
+
+class Operator(Query):
+    def __init__(self, *operands):
+        self.operands = frozenset(operands)
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.operands == other.operands
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.__class__) ^ hash(self.operands)
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            ", ".join(sorted(map(repr, self.operands)))
+        )
+
+
+class And(Operator):
+    """
+    Satisfied by the documents satisfying all `operands`.
+    """
+    def evaluate(self, index):
+        # evaluating the most selective operands - trigrams - first keeps
+        # the intermediate sets small.
+        operands = sorted(
+            self.operands, key=lambda operand: not isinstance(operand, Trigram)
+        )
+        result = operands[0].evaluate(index)
+        for operand in operands[1:]:
+            if not result:
+                break
+            result &= operand.evaluate(index)
+        return result
+
+
+class Or(Operator):
+    """
+    Satisfied by the documents satisfying any of the `operands`.
+    """
+    def evaluate(self, index):
+        result = set()
+        for operand in self.operands:
+            result |= operand.evaluate(index)
+        return result
+
+
+def and_(*queries):
+    operands = set()
+    for query in queries:
+        if isinstance(query, And):
+            operands.update(query.operands)
+        elif not isinstance(query, All):
+            operands.add(query)
+    if not operands:
+        return All()
+    elif len(operands) == 1:
+        return operands.pop()
+    return And(*operands)
+
+
+def or_(*queries):
+    operands = set()
+    for query in queries:
+        if isinstance(query, All):
+            return query
+        elif isinstance(query, Or):
+            operands.update(query.operands)
+        else:
+            operands.add(query)
+    if len(operands) == 1:
+        return operands.pop()
+    return Or(*operands)
+
+
+def get_strings_query(strings):
+    """
+    Returns a query satisfied by documents containing any of `strings`.
+    """
+    if any(len(string) < 3 for string in strings):
+        return All()
+    return or_(*[
+        and_(*map(Trigram, iter_trigrams(string))) for string in strings
+    ])
+
+
+def _cross(left, right):
+    return frozenset(a + b for a, b in product(left, right))
+
+
+class _Info(object):
+    # What is known about the strings matched by a regex: `exact` is the set
+    # of these strings or `None` if unknown, otherwise every string starts
+    # with a string in `prefix` and ends with a string in `suffix`. `match`
+    # is a query all documents containing a match satisfy.
+    def __init__(self, exact=None, prefix=frozenset([u""]),
+                 suffix=frozenset([u""]), match=All()):
+        self.exact = exact
+        self.prefix = prefix
+        self.suffix = suffix
+        self.match = match
+
+    def get_query(self):
+        if self.exact is not None:
+            return and_(self.match, get_strings_query(self.exact))
+        return and_(
+            self.match,
+            get_strings_query(self.prefix),
+            get_strings_query(self.suffix)
+        )
+
+    def simplify(self):
+        if self.exact is not None and len(self.exact) > MAX_STRINGS:
+            self = _Info(
+                prefix=self.exact, suffix=self.exact,
+                match=and_(self.match, get_strings_query(self.exact))
+            )
+        match = self.match
+        prefix, suffix = self.prefix, self.suffix
+        if len(prefix) > MAX_STRINGS:
+            match = and_(match, get_strings_query(prefix))
+            prefix = frozenset(string[:2] for string in prefix)
+        if len(suffix) > MAX_STRINGS:
+            match = and_(match, get_strings_query(suffix))
+            suffix = frozenset(string[-2:] for string in suffix)
+        if len(prefix) > MAX_STRINGS:
+            prefix = frozenset([u""])
+        if len(suffix) > MAX_STRINGS:
+            suffix = frozenset([u""])
+        return _Info(self.exact, prefix, suffix, match)
+
+
+def _concatenate(left, right):
+    match = and_(left.match, right.match)
+    if left.exact is not None and right.exact is not None:
+        return _Info(
+            exact=_cross(left.exact, right.exact), match=match
+        ).simplify()
+    if left.exact is None:
+        prefix = left.prefix
+    else:
+        prefix = _cross(left.exact, right.prefix)
+    if right.exact is None:
+        suffix = right.suffix
+    else:
+        suffix = _cross(left.suffix, right.exact)
+    # a match contains a suffix of the left and a prefix of the right match
+    boundaries = _cross(
+        left.suffix if left.exact is None else left.exact,
+        right.prefix if right.exact is None else right.exact
+    )
+    if len(boundaries) <= MAX_STRINGS:
+        match = and_(match, get_strings_query(boundaries))
+    return _Info(prefix=prefix, suffix=suffix, match=match).simplify()
+
+
+def _union(left, right):
+    if left.exact is not None and right.exact is not None:
+        return _Info(
+            exact=left.exact | right.exact,
+            match=or_(left.match, right.match)
+        ).simplify()
+    return _Info(
+        prefix=(
+            left.prefix if left.exact is None else left.exact
+        ) | (
+            right.prefix if right.exact is None else right.exact
+        ),
+        suffix=(
+            left.suffix if left.exact is None else left.exact
+        ) | (
+            right.suffix if right.exact is None else right.exact
+        ),
+        match=or_(left.get_query(), right.get_query())
+    ).simplify()
+
+
+def _get_info(regex):
+    if isinstance(regex, Epsilon):
+        return _Info(exact=frozenset([u""]))
+    elif isinstance(regex, Character):
+        return _Info(exact=frozenset([regex.raw]))
+    elif isinstance(regex, (Either, Range)):
+        characters = frozenset(
+            character.raw for character in regex
+        ) if isinstance(regex, Range) else frozenset(regex._raw_characters())
+        if len(characters) <= MAX_STRINGS:
+            return _Info(exact=characters)
+        return _Info()
+    elif isinstance(regex, Concatenation):
+        return reduce(_concatenate, map(_get_info, regex.operands))
+    elif isinstance(regex, Union):
+        return reduce(_union, map(_get_info, regex.operands))
+    elif isinstance(regex, CountedRepetition):
+        repeated = _get_info(regex.repeated)
+        if regex.maximum is not None and regex.maximum <= 3:
+            return reduce(_union, [
+                reduce(_concatenate, [repeated] * copies, _Info(
+                    exact=frozenset([u""])
+                ))
+                for copies in xrange(regex.minimum, regex.maximum + 1)
+            ])
+        if regex.minimum == 0:
+            return _Info()
+        copies = min(regex.minimum, 3)
+        info = reduce(_concatenate, [repeated] * copies)
+        if regex.maximum is None or regex.maximum > copies:
+            info = _concatenate(info, _Info())
+        return info
+    elif isinstance(regex, Group):
+        return _get_info(regex.grouped)
+    # repetitions, any and neither can match (almost) anything
+    return _Info()
+
+
+def get_query(regex):
+    """
+    Returns a :class:`Query` satisfied by every document containing a match
+    of `regex`.
+    """
+    return _get_info(regex).get_query()
+
+
+def _get_key(trigram):
+    a, b, c = map(ord, trigram)
+    return a << 42 | b << 21 | c
+
+
+_HEADER = struct.Struct("<8sIII")
+_ENTRY = struct.Struct("<QII")
+_MAGIC = "RGXTRI01"
+
+
+def write_index(documents, file):
+    """
+    Writes an index of `documents`, an iterable of ``(name, text)`` pairs,
+    to the binary `file`.
+
+    The index consists of a header, a table of the trigrams sorted by key,
+    each with the position and length of its postings, the postings - the
+    ids of the documents containing the trigram - and the names of the
+    documents. Every part has a fixed size or is stored at a known offset,
+    so the index can be used directly from a memory map.
+    """
+    postings = {}
+    names = []
+    for id, (name, text) in enumerate(documents):
+        names.append(name)
+        for trigram in set(iter_trigrams(text)):
+            postings.setdefault(_get_key(trigram), []).append(id)
+    keys = sorted(postings)
+    file.write(_HEADER.pack(
+        _MAGIC, len(names), len(keys), sum(map(len, postings.itervalues()))
+    ))
+    position = 0
+    for key in keys:
+        file.write(_ENTRY.pack(key, position, len(postings[key])))
+        position += len(postings[key])
+    for key in keys:
+        ids = postings[key]
+        file.write(struct.pack("<%dI" % len(ids), *ids))
+    for name in names:
+        name = name.encode("utf-8")
+        file.write(struct.pack("<I", len(name)))
+        file.write(name)
+
+
+def build_index(paths, index_path, encoding="utf-8"):
+    """
+    Writes an index of the files at `paths` to `index_path`.
+    """
+    with open(index_path, "wb") as file:
+        write_index(
+            ((path, read_text(path, encoding)) for path in paths), file
+        )
+
+
+class TrigramIndex(object):
+    """
+    An index written by :func:`write_index` and read through a memory map
+    of the file at `path`.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic, document_count, self._trigram_count, postings_count
+        ) = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC:
+            raise ValueError("%s is not a trigram index" % path)
+        self._postings_offset = (
+            _HEADER.size + self._trigram_count * _ENTRY.size
+        )
+        self.documents = []
+        offset = self._postings_offset + postings_count * 4
+        for _ in xrange(document_count):
+            length, = struct.unpack_from("<I", self._map, offset)
+            offset += 4
+            self.documents.append(
+                self._map[offset:offset + length].decode("utf-8")
+            )
+            offset += length
+
+    def get_postings(self, trigram):
+        """
+        Returns an array of the ids of the documents containing `trigram`.
+        """
+        key = _get_key(trigram)
+        low, high = 0, self._trigram_count
+        while low < high:
+            middle = (low + high) // 2
+            entry = _ENTRY.unpack_from(
+                self._map, _HEADER.size + middle * _ENTRY.size
+            )
+            if entry[0] < key:
+                low = middle + 1
+            elif entry[0] > key:
+                high = middle
+            else:
+                return array("I", struct.unpack_from(
+                    "<%dI" % entry[2],
+                    self._map,
+                    self._postings_offset + entry[1] * 4
+                ))
+        return array("I")
+
+    def get_candidates(self, regex):
+        """
+        Returns a sorted list of the names of the documents that may contain
+        a match of `regex`.
+        """
+        if isinstance(regex, basestring):
+            regex = parse(regex)
+        ids = get_query(regex).evaluate(self)
+        return [self.documents[id] for id in sorted(ids)]
+
+    def search(self, regex, encoding="utf-8"):
+        """
+        Yields ``(name, find)`` for every match of `regex` in the indexed
+        files, searching only the candidates.
+        """
+        if isinstance(regex, basestring):
+            regex = parse(regex)
+        matcher = regex.compile()
+        for name in self.get_candidates(regex):
+            for find in matcher.find_all(read_text(name, encoding)):
+                yield name, find
+
+    def close(self):
+        self._map.close()
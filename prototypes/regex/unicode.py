@@ -0,0 +1,154 @@
+# coding: utf-8
+"""
+    regex.unicode
+    ~~~~~~~~~~~~~
+
+    Unicode character classes and case folding, backed by the tables in
+    ``unicode_tables.txt``, which are generated ahead of time by
+    :func:`generate_tables` and loaded, when they are first used.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+import os
+import sys
+import unicodedata
+
+from regex.intervals import IntervalSet
+
+
+TABLES_PATH = os.path.join(os.path.dirname(__file__), "unicode_tables.txt")
+
+_tables = None
+_case_variants = None
+
+
+def _simple_fold(character):
+    # the simple case folding of `character`, Python 2 has no casefold but
+    # mapping to upper and then to lower case ends up at the same character
+    # for all characters, that are equal ignoring case. The dotted and
+    # dotless i are only folded in Turkic languages.
+    if character in u"\u0130\u0131":
+        return character
+    for mapping in [unicode.upper, unicode.lower]:
+        mapped = mapping(character)
+        if len(mapped) == 1:
+            character = mapped
+    return character
+
+
+def generate_tables(file):
+    """
+    Writes the intervals of every general category and of the whitespace
+    characters to `file`, one line per table: the name of the table followed
+    by hexadecimal ``start-end`` pairs.
+
+    The characters, that are equal ignoring case, are written to a ``case``
+    line as comma separated groups of hexadecimal code points.
+    """
+    tables = {}
+    folds = {}
+    for code in xrange(sys.maxunicode + 1):
+        names = [unicodedata.category(unichr(code))]
+        if unichr(code).isspace():
+            names.append("space")
+        for name in names:
+            intervals = tables.setdefault(name, [])
+            if intervals and intervals[-1][1] == code - 1:
+                intervals[-1][1] = code
+            else:
+                intervals.append([code, code])
+        folds.setdefault(_simple_fold(unichr(code)), []).append(code)
+    file.write("# generated with Unicode %s\n" % unicodedata.unidata_version)
+    for name in sorted(tables):
+        file.write("%s %s\n" % (name, " ".join(
+            "%x-%x" % tuple(interval) for interval in tables[name]
+        )))
+    file.write("case %s\n" % " ".join(
+        ",".join("%x" % code for code in codes)
+        for codes in sorted(folds.itervalues()) if len(codes) > 1
+    ))
+
+
+def _load_tables():
+    global _tables, _case_variants
+    if _tables is None:
+        tables = {}
+        case_variants = {}
+        with open(TABLES_PATH) as file:
+            for line in file:
+                if line.startswith("#"):
+                    continue
+                name, intervals = line.split(" ", 1)
+                if name == "case":
+                    for group in intervals.split():
+                        variants = tuple(
+                            unichr(int(code, 16)) for code in group.split(",")
+                        )
+                        for character in variants:
+                            case_variants[character] = variants
+                    continue
+                tables[name.decode("ascii")] = IntervalSet(
+                    tuple(int(code, 16) for code in interval.split("-"))
+                    for interval in intervals.split()
+                )
+        _tables, _case_variants = tables, case_variants
+    return _tables
+
+
+def get_property(name):
+    """
+    Returns the :class:`IntervalSet` of the characters with the general
+    category `name`, which is either a category like ``Lu`` or a major class
+    like ``L``. Raises :exc:`KeyError` for unknown names.
+    """
+    tables = _load_tables()
+    if name in tables:
+        return tables[name]
+    categories = [
+        table for category, table in tables.iteritems()
+        if len(category) == 2 and category[0] == name
+    ]
+    if len(name) != 1 or not categories:
+        raise KeyError(name)
+    return reduce(IntervalSet.__or__, categories)
+
+
+def get_shorthand(name):
+    """
+    Returns the :class:`IntervalSet` of the class `name`, one of ``digit``,
+    ``word`` and ``space``.
+    """
+    if name == u"digit":
+        return get_property(u"Nd")
+    elif name == u"word":
+        return (
+            get_property(u"L") | get_property(u"N") |
+            IntervalSet.from_characters(u"_")
+        )
+    elif name == u"space":
+        return _load_tables()[u"space"]
+    raise KeyError(name)
+
+
+def get_case_variants(character):
+    """
+    Returns a tuple of the characters equal to `character` ignoring case,
+    including `character` itself.
+    """
+    _load_tables()
+    return _case_variants.get(character, (character, ))
+
+
+def fold_case(characters):
+    """
+    Returns the :class:`IntervalSet` of the characters equal to any of the
+    given `characters` ignoring case. Only the characters with case variants
+    are looked up, the intervals are never expanded.
+    """
+    _load_tables()
+    variants = set()
+    for character, group in _case_variants.iteritems():
+        if character in characters:
+            variants.update(group)
+    return characters | IntervalSet.from_characters(variants)
@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+    regex.words
+    ~~~~~~~~~~~
+
+    Builds automata matching a list of words directly, without parsing a
+    regex and constructing an NFA, which is considerably faster for keyword
+    tables or blocklists with many thousands of entries.
+
+    :copyright: 2012 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst
+"""
+from regex.fa import DFAState, DFA
+
+
+def _get_signature(state):
+    return state.is_final, tuple(sorted(
+        (movement, id(target))
+        for movement, target in state.movements.iteritems()
+    ))
+
+
+def _get_common_prefix_length(a, b):
+    for length in xrange(min(len(a), len(b))):
+        if a[length] != b[length]:
+            return length
+    return min(len(a), len(b))
+
+
+def words_to_dfa(words):
+    """
+    Returns a minimal :class:`DFA` matching exactly the given `words`, using
+    the incremental construction by Daciuk et al.
+
+    The words have to be sorted, duplicates are ignored. Raises
+    :exc:`ValueError` if the words are not sorted.
+    """
+    start = DFAState()
+    register = {}
+    # the states for every prefix of the previous word
+    path = [start]
+    previous = None
+
+    def replace_or_register(depth):
+        # replaces the states in the path deeper than `depth`, with an
+        # equivalent registered state or registers them.
+        for i in xrange(len(path) - 1, depth, -1):
+            state = path[i]
+            signature = _get_signature(state)
+            try:
+                registered = register[signature]
+            except KeyError:
+                register[signature] = state
+            else:
+                path[i - 1].movements[previous[i - 1]] = registered
+        del path[depth + 1:]
+
+    for word in words:
+        if previous is not None:
+            if word == previous:
+                continue
+            elif word < previous:
+                raise ValueError(
+                    "words are not sorted: %r follows %r" % (word, previous)
+                )
+            replace_or_register(_get_common_prefix_length(word, previous))
+        for character in word[len(path) - 1:]:
+            state = DFAState()
+            path[-1].movements[character] = state
+            path.append(state)
+        path[-1].is_final = True
+        previous = word
+    if previous is not None:
+        replace_or_register(0)
+    finals = [
+        (signature, state) for signature, state in register.iteritems()
+        if state.is_final
+    ]
+    if start.is_final:
+        finals.append((_get_signature(start), start))
+    return DFA(start, finals)
+
+
+def compile_words(words, table=True):
+    """
+    Returns a :class:`DFATable` matching exactly the given sorted `words` or
+    a :class:`DFA`, if `table` is `False`.
+
+    The result can be used in place of a regex in :class:`Tokenizer`
+    definitions.
+    """
+    dfa = words_to_dfa(words)
+    if table:
+        return dfa.to_dfa_table()
+    return dfa